@@ -1,18 +1,78 @@
+from contextlib import aclosing
+import asyncio
 import logging
+import math
+import time
 
 import discord
 
 import globalconf as _globalconf
+from . import admission as _admission
+from . import backends as _backends
 from . import botconf as _botconf
 from . import bothist as _bothist
+from . import commands as _commands
+from . import confwatch as _confwatch
+from . import diagnostics as _diagnostics
 from . import llm
+from . import metrics as _metrics
+from . import modelpull as _modelpull
+from . import respcache as _respcache
+from . import retrieval as _retrieval
+from . import routing as _routing
+from . import scheduler as _scheduler
+from . import sharedstore as _sharedstore
+from . import summarizer as _summarizer
+from . import warmup as _warmup
 
 logger = logging.getLogger(__name__)
 
 _intents = discord.Intents.default()
 _intents.message_content = True
 
-client = discord.Client(intents=_intents)
+
+class _BotClientMixin:
+    async def close(self) -> None:
+        # Release pooled LLM connections, and write the remaining
+        # history, before the event loop goes away
+        _diagnostics.loop_lag_monitor.stop()
+        await _confwatch.config_watcher.stop()
+        await _summarizer.summarizer.stop()
+        await _retrieval.retriever.stop()
+        await _warmup.model_warmer.stop()
+        await _modelpull.model_puller.stop()
+        await _backends.backend_pool.stop()
+        await _metrics.registry.close()
+        await llm.llm_client.close()
+        await _bothist.bot_history.close_store()
+        await _sharedstore.close_shared_store()
+        await super().close()  # type: ignore[misc]
+
+
+class _BotClient(_BotClientMixin, discord.Client):
+    pass
+
+
+class _ShardedBotClient(_BotClientMixin, discord.AutoShardedClient):
+    pass
+
+
+def _make_client() -> discord.Client:
+    if not _globalconf.is_sharded():
+        return _BotClient(intents=_intents)
+
+    logger.info(
+        f"running shards {_globalconf.SHARD_IDS or 'all'} of " +
+        f"{_globalconf.SHARD_COUNT or 'auto'}"
+    )
+    return _ShardedBotClient(
+        intents=_intents,
+        shard_count=_globalconf.SHARD_COUNT,
+        shard_ids=_globalconf.SHARD_IDS,
+    )
+
+
+client = _make_client()
 
 
 def _is_command(text: str) -> bool:
@@ -20,13 +80,8 @@ def _is_command(text: str) -> bool:
 
 
 def _is_greeting(message: discord.Message) -> bool:
-    has_greeting_prefix = False
-    for greeting in _botconf.bot_config.greetings:
-        if message.content.lower().startswith(greeting):
-            has_greeting_prefix = True
-            break
-
-    if not has_greeting_prefix:
+    matcher = _commands.greeting_matcher(_botconf.bot_config)
+    if matcher is None or matcher.match(message.content) is None:
         return False
 
     return client.user in message.mentions
@@ -73,44 +128,386 @@ def _split_text(text: str, max_len: int = 2000) -> list[str]:
             return split_text
 
 
-async def _handle_command(
-    command: str,
-    args: list[str],
+class _StreamedReply:
+    """
+    Progressively reply to a message with a response that is being
+    streamed from the LLM.
+    The first reply is posted once there is a useful prefix of the
+    response, and is then edited at most once every `edit_interval`
+    seconds as more of the response arrives.
+    Once the response no longer fits in a single message, it rolls
+    over into a new reply, split the same way as `_split_text`.
+    """
+    message: discord.Message
+    """The message being replied to"""
+    text: str
+    """The response received so far"""
+    replies: list[discord.Message]
+    """The replies posted so far"""
+    reply_texts: list[str]
+    """The current content of each of the replies"""
+
+    def __init__(
+        self,
+        message: discord.Message,
+        min_prefix: int,
+        edit_interval: float,
+    ) -> None:
+        self.message = message
+        self.text = ""
+        self.replies = []
+        self.reply_texts = []
+        self._min_prefix = min_prefix
+        self._edit_interval = edit_interval
+        self._last_edit = 0.0
+
+    async def feed(self, chunk: str) -> None:
+        """
+        Add a chunk of the response, and update the replies if needed
+        """
+        self.text += chunk
+        if (len(self.replies) == 0
+                and len(self.text.strip()) < self._min_prefix):
+            return
+
+        await self._sync(final=False)
+
+    async def finish(self) -> list[discord.Message]:
+        """
+        Make the replies match the full response, and return them
+        """
+        await self._sync(final=True)
+        return self.replies
+
+    async def _sync(self, final: bool) -> None:
+        pages = _split_text(self.text)
+        for i, page in enumerate(pages):
+            # Discord doesn't allow empty messages
+            if page == "":
+                continue
+
+            # Only the last page can still change
+            is_last = i == len(pages) - 1
+
+            if i >= len(self.replies):
+                started = time.monotonic()
+                self.replies.append(await self.message.reply(page))
+                _metrics.discord_send.observe(
+                    time.monotonic() - started,
+                    operation="reply",
+                )
+                self.reply_texts.append(page)
+                self._last_edit = time.monotonic()
+                continue
+
+            if self.reply_texts[i] == page:
+                continue
+
+            now = time.monotonic()
+            if is_last and not final:
+                # Throttle edits to stay within Discord's rate limits
+                if now - self._last_edit < self._edit_interval:
+                    continue
+
+            self.replies[i] = await self.replies[i].edit(content=page)
+            self.reply_texts[i] = page
+            self._last_edit = time.monotonic()
+            _metrics.discord_send.observe(
+                self._last_edit - now,
+                operation="edit",
+            )
+
+
+async def _stream_reply(
     message: discord.Message,
-):
-    response = ""
-    pre = _botconf.bot_config.command_prefix
-    match command.lower():
-        case "help" | "h":
-            response += (
-                "```\n" +
-                pre+"help       " + pre+"h  -  " + "show this help message\n" +
-                pre+"resources  " + pre+"r  -  " + "list resources\n" +
-                "```"
+    config: _botconf.BotConfig,
+    model: str,
+) -> tuple[str | None, list[discord.Message]]:
+    """
+    Stream a response to `message` from `model`, returning the response
+    (None if it was cut short) and the posted replies
+    """
+    status = llm.StreamStatus()
+    reply = _StreamedReply(
+        message,
+        config.stream_min_prefix,
+        config.stream_edit_interval,
+    )
+    try:
+        # Closing the stream right away aborts the request to the LLM
+        # if the reply is cancelled
+        async with aclosing(
+            llm.stream_response(
+                message,
+                config=config,
+                model=model,
+                status=status,
             )
+        ) as stream:
+            async for chunk in stream:
+                await reply.feed(chunk)
+    except asyncio.CancelledError:
+        # Don't leave half of a reply to a message that was deleted or
+        # edited
+        for r in reply.replies:
+            try:
+                await r.delete()
+            except discord.HTTPException as e:
+                logger.warning(f"failed to delete partial reply: {e}")
+        raise
+
+    replies = await reply.finish()
+    logger.info("response: `%s`", reply.text)
+    return reply.text if status.complete else None, replies
+
+
+async def _send_reply(
+    message: discord.Message,
+    response: str,
+) -> list[discord.Message]:
+    """
+    Reply to `message` with `response`, returning the posted replies
+    """
+    # Split message into <=2000 character chunks
+    message_chunks: list[discord.Message] = []
+    for response_chunk in _split_text(response):
+        started = time.monotonic()
+        message_chunks.append(await message.reply(response_chunk))
+        _metrics.discord_send.observe(
+            time.monotonic() - started,
+            operation="reply",
+        )
 
-        case "resources" | "r":
-            if len(_botconf.bot_config.resources) == 0:
-                response += "There are currently no resources"
-            else:
-                for r in _botconf.bot_config.resources:
-                    response += "- " + str(r) + "\n"
-        case _:
-            response += "Unknown command. Type `" + pre+"help` for help"
+    return message_chunks
 
-    await message.channel.send(response, suppress_embeds=True)
+
+async def _reply(
+    message: discord.Message,
+    config: _botconf.BotConfig,
+    model: str,
+) -> tuple[str | None, list[discord.Message]]:
+    """
+    Generate a whole response to `message` with `model`, then reply with
+    it, returning the response (None if it couldn't be generated) and
+    the posted replies
+    """
+    response = await llm.generate_response(
+        message,
+        config=config,
+        model=model,
+    )
+    logger.info("response: `%s`", response)
+    if response is None:
+        return None, []
+
+    return response, await _send_reply(message, response)
+
+
+def _cache_key(
+    message: discord.Message,
+    config: _botconf.BotConfig,
+    model: str,
+) -> str | None:
+    """
+    Return the key of the response of `model` to `message` in the
+    response cache, or None if the cache is disabled
+    """
+    if not config.response_cache_enabled:
+        return None
+
+    context: list[str] = []
+    if config.response_cache_context > 0:
+        # The newest entry is the message itself
+        entries = list(_bothist.bot_history.entries(message.channel.id))
+        context = [
+            e.content
+            for e in entries[-config.response_cache_context-1:-1]
+        ]
+
+    return _respcache.make_key(
+        model,
+        config.system_prompt,
+        message.content,
+        context,
+    )
+
+
+async def _defer_for_pull(message: discord.Message, model: str) -> None:
+    """
+    Tell the author of `message` that `model` is being pulled, and wait
+    for the pull to finish
+    """
+    logger.info(f"waiting for {model} to be pulled")
+    await message.reply(
+        _bothist.PULL_NOTICE + f"(`{model}`), " +
+        "I'll answer once it's ready. " +
+        f"Type `{_botconf.bot_config.command_prefix}model` to see " +
+        "the progress.",
+        suppress_embeds=True,
+    )
+    await _modelpull.model_puller.wait(model)
+
+
+async def _respond(
+    message: discord.Message,
+    config: _botconf.BotConfig,
+    route: _botconf.Route,
+    cache_key: str | None = None,
+) -> bool:
+    """
+    Reply to a message that mentioned the bot with `config` and the
+    model of its `route`, and add the reply to the history.
+    If `cache_key` is given, the response is added to the response
+    cache under it.
+    Return False if the model turned out to be missing and is being
+    pulled, in which case the mention has to be answered again once
+    the model is ready.
+    """
+    model = route.model
+    started = time.monotonic()
+    if config.stream_responses:
+        response, replies = await _stream_reply(message, config, model)
+    else:
+        response, replies = await _reply(message, config, model)
+
+    if len(replies) == 0 and _modelpull.model_puller.is_pulling(model):
+        # Don't hold the generation slot during the download
+        return False
+
+    if len(replies) > 0:
+        # Add the reply to the history
+        _bothist.bot_history.add_message(replies, is_bot=True)
+        # Only cache whole responses
+        if cache_key is not None and response is not None:
+            await _respcache.response_cache.put(cache_key, response)
+
+        _metrics.mentions.inc(channel=message.channel.id, outcome="answered")
+        _metrics.route_duration.observe(
+            time.monotonic() - started,
+            route=route.name,
+        )
+        await client.change_presence(status=discord.Status.online)
+    else:
+        _metrics.mentions.inc(channel=message.channel.id, outcome="failed")
+        await client.change_presence(status=discord.Status.idle)
+    return True
+
+
+async def _generate(
+    message: discord.Message,
+    config: _botconf.BotConfig,
+    route: _botconf.Route,
+    cache_key: str | None,
+) -> bool | None:
+    """
+    Queue the response to a mention, and wait for it.
+    Return the result of `_respond`, or None if the job was dropped,
+    merged into a newer one or cancelled.
+    """
+    job = _scheduler.generation_scheduler.submit(
+        message.channel.id,
+        lambda: _respond(message, config, route, cache_key),
+        message.id,
+        message.author.id,
+    )
+    if job is None:
+        logger.info("mention dropped, channel queue is full")
+        return None
+
+    return await job.wait()
+
+
+def _collect_metrics() -> None:
+    history = _bothist.bot_history.memory_stats()
+    _metrics.history_channels.set(history["channels"])
+    _metrics.history_entries.set(history["entries"])
+    _metrics.history_bytes.set(history["bytes"])
+
+    scheduler = _scheduler.generation_scheduler
+    _metrics.queue_depth.set(scheduler.depth())
+    _metrics.in_flight.set(scheduler.in_flight)
+    _metrics.expected_wait.set(scheduler.expected_wait())
+    if scheduler.run_time is not None:
+        _metrics.generation_run_time.set(scheduler.run_time)
+
+    for backend in _backends.backend_pool.backends:
+        _metrics.backend_outstanding.set(
+            backend.outstanding,
+            backend=backend.url,
+        )
+        _metrics.backend_available.set(
+            int(backend.available),
+            backend=backend.url,
+        )
+
+    retriever = _retrieval.retriever
+    _metrics.retrieval_documents.set(
+        len(retriever.resources),
+        index="resources",
+    )
+    _metrics.retrieval_documents.set(len(retriever.messages), index="messages")
+
+    cache = _respcache.response_cache
+    _metrics.response_cache.set_total(cache.hits, result="hit")
+    _metrics.response_cache.set_total(cache.misses, result="miss")
+
+
+_metrics.registry.collectors.append(_collect_metrics)
+
+
+def _on_config_change(
+    old: _botconf.BotConfig,
+    new: _botconf.BotConfig,
+) -> None:
+    old_models = _routing.models(old)
+    new_models = _routing.models(new)
+    if new_models != old_models:
+        logger.info(f"models changed from {old_models} to {new_models}")
+        if new.auto_pull_model:
+            for model in new_models:
+                _modelpull.model_puller.ensure(model)
+        _warmup.model_warmer.start()
+
+
+_confwatch.config_watcher.listeners.append(_on_config_change)
+_bothist.bot_history.archive_listeners.append(_retrieval.retriever.archive)
 
 
 @client.event
 async def on_ready():
     logger.info(f"Logged in as {client.user}")
+    _diagnostics.loop_lag_monitor.start()
+    await llm.llm_client.start()
+    await _backends.backend_pool.start(llm.llm_client.session)
+    _modelpull.model_puller.start(llm.llm_client.session)
+    if _botconf.bot_config.auto_pull_model:
+        for model in _routing.models(_botconf.bot_config):
+            _modelpull.model_puller.ensure(model)
+    # Load the models in the background, so the first mention doesn't
+    # have to wait for them
+    _warmup.model_warmer.start()
+    if _botconf.bot_config.persist_history:
+        await _bothist.bot_history.open_store(_globalconf.DB_FILE)
+    if _globalconf.WORKERS > 1:
+        await _sharedstore.open_shared_store(_globalconf.SHARED_DB_FILE)
+    if _globalconf.METRICS_PORT is not None:
+        await _metrics.registry.serve(
+            _globalconf.METRICS_HOST,
+            _globalconf.METRICS_PORT,
+        )
+    _confwatch.config_watcher.start()
+    _summarizer.summarizer.start()
+    _retrieval.retriever.start(llm.llm_client.session)
 
 
 @client.event
 async def on_message(message: discord.Message):
+    # Use the same config for the whole message, even if it is reloaded
+    config = _botconf.bot_config
+
     # Don't respond to messages from different guilds if it is enforced
     if not _in_guild(message):
-        if _botconf.bot_config.enforce_guild:
+        if config.enforce_guild:
             return
 
     # Don't respond to this bot's own messages
@@ -119,44 +516,110 @@ async def on_message(message: discord.Message):
 
     if _is_command(message.content):
         logger.info("received command")
-        split_message = message.content.strip(" \t\n").split()
-        command = split_message[0][len(_botconf.bot_config.command_prefix):]
-        args = split_message[1:]
-
-        await _handle_command(command, args, message)
+        await _commands.registry.dispatch(message.content, message, config)
         return
 
     # Add message to history
-    _bothist.bot_history.add_message([message])
-
-    if client.user in message.mentions:
+    mentioned = client.user in message.mentions
+    if config.history_mode == "lazy":
+        if mentioned:
+            await _bothist.bot_history.backfill(message, client.user)
+        if _bothist.bot_history.is_active(message.channel.id):
+            _bothist.bot_history.add_message([message])
+    else:
+        await _bothist.bot_history.warm(message.channel.id)
+        _bothist.bot_history.add_message([message])
+
+    if mentioned:
         logger.info("received message")
 
-        response = await llm.generate_response(
-            message,
-            _botconf.bot_config.system_prompt,
-        )
-        logger.info(f"response: `{response}`")
-        if response is not None:
-            if len(response) > 2000:
-                # Split message into <=2000 character chunks
-                message_chunks: list[discord.Message] = []
-                for response_chunk in _split_text(response):
-                    message_chunks.append(await message.reply(response_chunk))
-
-                _bothist.bot_history.add_message(
-                    message_chunks,
-                    is_bot=True,
+        route = _routing.router.choose(message, config)
+        cache_key = _cache_key(message, config, route.model)
+        if cache_key is not None:
+            cached = await _respcache.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("replying with cached response")
+                _metrics.mentions.inc(
+                    channel=message.channel.id,
+                    outcome="cached",
                 )
-            else:
-                # Reply to the message, and add the reply to the history
                 _bothist.bot_history.add_message(
-                    [await message.reply(response)],
+                    await _send_reply(message, cached),
                     is_bot=True,
                 )
+                return
 
-            await client.change_presence(status=discord.Status.online)
-        else:
-            await client.change_presence(status=discord.Status.idle)
+        retry_after = await _admission.admission_controller.admit(
+            message.author.id,
+            message.channel.id,
+            config,
+        )
+        if retry_after > 0:
+            logger.info(
+                "mention refused, retry after %.1fs",
+                retry_after,
+                extra={"user": message.author.id},
+            )
+            _metrics.mentions.inc(
+                channel=message.channel.id,
+                outcome="refused",
+            )
+            if _admission.admission_controller.should_notify(
+                message.author.id,
+                retry_after,
+            ):
+                await message.reply(
+                    _bothist.BUSY_NOTICE +
+                    f"{math.ceil(retry_after)}s",
+                    mention_author=False,
+                )
+            return
+
+        if _modelpull.model_puller.is_pulling(route.model):
+            await _defer_for_pull(message, route.model)
+
+        # Summaries can wait, the mention can't
+        _summarizer.summarizer.interrupt()
+
+        if config.cancel_superseded:
+            # Only answer the newest mention of each user
+            _scheduler.generation_scheduler.cancel_user(
+                message.author.id,
+                message.channel.id,
+            )
+
+        if await _generate(message, config, route, cache_key) is False:
+            # The model was missing, and is now being pulled, so try
+            # again once it is ready, without holding a slot meanwhile
+            await _defer_for_pull(message, route.model)
+            if await _generate(message, config, route, cache_key) is False:
+                _metrics.mentions.inc(
+                    channel=message.channel.id,
+                    outcome="failed",
+                )
+        return
+    logger.info("message didn't mention the bot", extra={"sampled": True})
+
+
+@client.event
+async def on_message_delete(message: discord.Message):
+    # Stop answering a deleted message, and forget it
+    if _scheduler.generation_scheduler.cancel_message(message.id):
+        logger.info("message deleted, cancelled its response")
+    await _bothist.bot_history.remove_message(message.channel.id, message.id)
+    _retrieval.retriever.forget(message.id)
+
+
+@client.event
+async def on_message_edit(before: discord.Message, after: discord.Message):
+    # Streamed replies are edited by the bot, and embeds being loaded
+    # also count as edits
+    if after.author == client.user or before.content == after.content:
         return
-    logger.info("message didn't mention the bot")
+
+    # The response would be to the old content
+    if _scheduler.generation_scheduler.cancel_message(after.id):
+        logger.info("message edited, cancelled its response")
+    await _bothist.bot_history.edit_message(after)
+    # Don't retrieve the old content
+    _retrieval.retriever.forget(after.id)
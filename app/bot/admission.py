@@ -0,0 +1,207 @@
+"""
+Rate limiting of mentions, so a single user or channel can't take up
+all of the LLM's time
+"""
+
+import logging
+import sqlite3
+import time
+
+from . import botconf as _botconf
+from . import metrics as _metrics
+from . import scheduler as _scheduler
+from . import sharedstore as _sharedstore
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens, and gains `rate` tokens per second.
+    Each admitted mention takes a token.
+    """
+    tokens: float
+    updated_at: float
+
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, rate: float, burst: float, now: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def wait_time(self, rate: float) -> float:
+        """
+        Seconds until a token is available (0 if one is available now)
+        """
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class _Limit:
+    """
+    Token buckets of the same kind, one per user or channel
+    """
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, TokenBucket] = {}
+
+    def bucket(
+        self,
+        key: int,
+        rate: float,
+        burst: float,
+        now: float,
+    ) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= 4096:
+                self._prune(rate, burst, now)
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+        else:
+            bucket.refill(rate, burst, now)
+        return bucket
+
+    def _prune(self, rate: float, burst: float, now: float) -> None:
+        # A full bucket is the same as a new one, so it can be forgotten
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(rate, burst, now)
+            if bucket.tokens >= burst:
+                del self.buckets[key]
+
+
+class AdmissionController:
+    """
+    Decides whether to generate a response to a mention.
+
+    The limits are read from the bot config:
+    - `user_rate_limit` and `user_rate_burst`: mentions per minute
+      of each user, and how many can be made in a row
+    - `channel_rate_limit` and `channel_rate_burst`: the same, for
+      each channel
+    - `admission_max_wait`: the longest a mention may be expected to
+      wait for a generation slot, estimated from how long generations
+      take, so the total work in flight follows the speed of the LLM
+      servers
+    A limit of 0 disables it.
+
+    If the bot runs in several processes, the buckets are kept in the
+    shared store, so limits apply whichever shard gets a mention.
+    """
+
+    def __init__(self) -> None:
+        self._users = _Limit()
+        self._channels = _Limit()
+        self._notified: dict[int, float] = {}
+
+    async def admit(
+        self,
+        user_id: int,
+        channel_id: int,
+        config: _botconf.BotConfig,
+    ) -> float:
+        """
+        Check whether a mention by a user in a channel can be answered
+        with `config`, and if so, count it against their limits.
+        Return 0 if it is admitted, or the number of seconds to wait
+        before trying again.
+        """
+        now = time.monotonic()
+
+        if config.admission_max_wait > 0:
+            wait = _scheduler.generation_scheduler.expected_wait()
+            if wait > config.admission_max_wait:
+                _metrics.admission.inc(outcome="busy")
+                return wait - config.admission_max_wait
+
+        store = _sharedstore.shared_store
+        if store is not None and store.is_open:
+            try:
+                return await self._admit_shared(
+                    store, user_id, channel_id, config,
+                )
+            except sqlite3.Error as e:
+                # Limit the mention with this process's buckets instead
+                logger.error(f"{type(e)}: {e}")
+
+        checks = []
+        if config.user_rate_limit > 0:
+            rate = config.user_rate_limit / 60
+            checks.append(("user", rate, self._users.bucket(
+                user_id, rate, max(1, config.user_rate_burst), now,
+            )))
+        if config.channel_rate_limit > 0:
+            rate = config.channel_rate_limit / 60
+            checks.append(("channel", rate, self._channels.bucket(
+                channel_id, rate, max(1, config.channel_rate_burst), now,
+            )))
+
+        # Only take tokens if every bucket has one
+        for limit, rate, bucket in checks:
+            wait = bucket.wait_time(rate)
+            if wait > 0:
+                _metrics.admission.inc(outcome=limit)
+                return wait
+
+        for _, _, bucket in checks:
+            bucket.take()
+        _metrics.admission.inc(outcome="admitted")
+        return 0.0
+
+    async def _admit_shared(
+        self,
+        store: _sharedstore.SharedStore,
+        user_id: int,
+        channel_id: int,
+        config: _botconf.BotConfig,
+    ) -> float:
+        buckets: list[_sharedstore.Bucket] = []
+        if config.user_rate_limit > 0:
+            buckets.append((
+                "user",
+                user_id,
+                config.user_rate_limit / 60,
+                max(1, config.user_rate_burst),
+            ))
+        if config.channel_rate_limit > 0:
+            buckets.append((
+                "channel",
+                channel_id,
+                config.channel_rate_limit / 60,
+                max(1, config.channel_rate_burst),
+            ))
+
+        refused = None
+        if len(buckets) > 0:
+            refused = await store.take(buckets, time.time())
+        if refused is not None:
+            limit, wait = refused
+            _metrics.admission.inc(outcome=limit)
+            return wait
+
+        _metrics.admission.inc(outcome="admitted")
+        return 0.0
+
+    def should_notify(self, user_id: int, retry_after: float) -> bool:
+        """
+        Check whether a user should be told to try again later, so they
+        are only told once until they can
+        """
+        now = time.monotonic()
+        if self._notified.get(user_id, 0.0) > now:
+            return False
+
+        if len(self._notified) >= 4096:
+            self._notified = {
+                k: t for k, t in self._notified.items() if t > now
+            }
+        self._notified[user_id] = now + retry_after
+        return True
+
+
+admission_controller = AdmissionController()
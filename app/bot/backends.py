@@ -0,0 +1,235 @@
+"""
+A pool of LLM servers, with health checks and load balancing
+"""
+
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+import globalconf as _globalconf
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_model(name: str) -> str:
+    """
+    Normalize a model name the way Ollama does, so that e.g. `llama2`
+    and `llama2:latest` compare equal
+    """
+    return name if ":" in name else name + ":latest"
+
+
+class Backend:
+    """
+    A single Ollama server
+    """
+    FAILURE_THRESHOLD: int = 3
+    """Consecutive failures after which the circuit breaker opens"""
+    COOLDOWN: float = 30.0
+    """Seconds the circuit breaker stays open"""
+
+    url: str
+    """Base URL of the server, e.g. `http://localhost:11434`"""
+    outstanding: int
+    """Number of requests currently being handled by the server"""
+    models: set[str]
+    """Models available on the server"""
+    loaded_models: set[str]
+    """Models currently loaded in the server's memory"""
+    healthy: bool
+    """Whether the last health check succeeded"""
+    failures: int
+    """Number of consecutive failed requests"""
+    open_until: float
+    """`time.monotonic()` until which the circuit breaker is open"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.models = set()
+        self.loaded_models = set()
+        # Assume the server is healthy until the first health check
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        """Whether requests can be sent to the server"""
+        return self.healthy and time.monotonic() >= self.open_until
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.FAILURE_THRESHOLD:
+            if self.available:
+                logger.warning(
+                    f"backend {self.url} failed {self.failures} times " +
+                    f"in a row, disabling it for {self.COOLDOWN} seconds"
+                )
+            self.open_until = time.monotonic() + self.COOLDOWN
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "url": self.url,
+            "available": self.available,
+            "outstanding": self.outstanding,
+            "models": sorted(self.models),
+            "loaded_models": sorted(self.loaded_models),
+            "failures": self.failures,
+        }
+
+
+class BackendPool:
+    """
+    Routes requests to the Ollama server with the fewest outstanding
+    requests, preferring servers that already have the model loaded.
+
+    Servers are checked in the background every `LLM_HEALTH_INTERVAL`
+    seconds. Servers that fail the check, or fail several requests in a
+    row, are skipped until they recover.
+    """
+    backends: list[Backend]
+
+    def __init__(self) -> None:
+        self.backends = []
+        self._session: aiohttp.ClientSession | None = None
+        self._health_task: asyncio.Task[None] | None = None
+
+    def configure(self, urls: list[str]) -> None:
+        if len(urls) == 0:
+            urls = [f"http://{_globalconf.LLM_HOST}:{_globalconf.LLM_PORT}"]
+        self.backends = [Backend(url) for url in urls]
+
+    def available_count(self) -> int:
+        return sum(1 for b in self.backends if b.available)
+
+    async def start(self, session: aiohttp.ClientSession) -> None:
+        """
+        Check every server using `session`, then keep checking them in
+        the background.
+        Does nothing if the checks are already running.
+        """
+        self._session = session
+        if len(self.backends) == 0:
+            self.configure(_globalconf.LLM_BACKENDS)
+
+        if self._health_task is not None and not self._health_task.done():
+            return
+
+        await self.check_all()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(_globalconf.LLM_HEALTH_INTERVAL)
+            await self.check_all()
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*[self.check(b) for b in self.backends])
+
+    async def check(self, backend: Backend) -> None:
+        """
+        Update the health, and available and loaded models of a server
+        """
+        if self._session is None:
+            return
+
+        session = self._session
+        timeout = aiohttp.ClientTimeout(total=_globalconf.LLM_CONNECT_TIMEOUT)
+        try:
+            async with session.get(
+                f"{backend.url}/api/tags",
+                timeout=timeout,
+            ) as res:
+                res.raise_for_status()
+                tags = await res.json()
+            async with session.get(
+                f"{backend.url}/api/ps",
+                timeout=timeout,
+            ) as res:
+                res.raise_for_status()
+                ps = await res.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if backend.healthy:
+                logger.warning(
+                    f"backend {backend.url} failed health check: " +
+                    f"{type(e)}: {e}"
+                )
+            backend.healthy = False
+            return
+
+        if not backend.healthy:
+            logger.info(f"backend {backend.url} is healthy again")
+        # The circuit breaker is left to the outcomes of requests, as a
+        # server can answer health checks while failing to generate
+        backend.healthy = True
+        backend.models = {
+            normalize_model(m["name"]) for m in tags.get("models") or []
+        }
+        backend.loaded_models = {
+            normalize_model(m["name"]) for m in ps.get("models") or []
+        }
+
+    def choose(self, model: str) -> Backend:
+        """
+        Choose the server to send a request for `model` to
+        """
+        if len(self.backends) == 0:
+            self.configure(_globalconf.LLM_BACKENDS)
+
+        available = [b for b in self.backends if b.available]
+        if len(available) == 0:
+            # Everything is down, so try the one that will recover first
+            return min(self.backends, key=lambda b: b.open_until)
+
+        model = normalize_model(model)
+
+        def rank(b: Backend) -> tuple[int, int]:
+            if model in b.loaded_models:
+                preference = 0
+            elif model in b.models:
+                preference = 1
+            else:
+                preference = 2
+            return (preference, b.outstanding)
+
+        return min(available, key=rank)
+
+    @asynccontextmanager
+    async def acquire(self, model: str) -> AsyncIterator[Backend]:
+        """
+        Choose a server for a request for `model`, and count the request
+        as outstanding on it until the context exits.
+        Connection errors and timeouts raised in the context count as
+        failures of the server.
+        """
+        backend = self.choose(model)
+        backend.outstanding += 1
+        try:
+            yield backend
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            backend.record_failure()
+            raise
+        else:
+            backend.record_success()
+        finally:
+            backend.outstanding -= 1
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [b.stats() for b in self.backends]
+
+
+backend_pool = BackendPool()
@@ -1,5 +1,7 @@
 from typing import Any
 import logging
+import os
+import threading
 
 import yaml
 
@@ -7,6 +9,10 @@ import globalconf as _globalconf
 
 logger = logging.getLogger(__name__)
 
+# The C loader is much faster, but is only available if PyYAML was built
+# with libyaml
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class Resource:
     """
@@ -30,54 +36,325 @@ class Resource:
         return s
 
 
+class Route:
+    """
+    A rule that sends the mentions it matches to a model other than the
+    `llm_model`
+    """
+    name: str
+    model: str
+    min_length: int
+    max_length: int | None
+    """
+    Lengths are in characters, of the message without its mentions
+    """
+    has_code: bool | None
+    """
+    Whether the message must contain a code block, or None if it doesn't
+    matter
+    """
+    channels: tuple[int, ...]
+    """Channels the route applies to, or all channels if empty"""
+    intents: tuple[str, ...]
+    """
+    Words one of which the message must start with (ignoring case), or
+    any words if empty
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        min_length: int = 0,
+        max_length: int | None = None,
+        has_code: bool | None = None,
+        channels: tuple[int, ...] = (),
+        intents: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.model = model
+        self.min_length = min_length
+        self.max_length = max_length
+        self.has_code = has_code
+        self.channels = channels
+        self.intents = intents
+
+
+def _parse_route(route: Any) -> Route | None:
+    """
+    Make a route from its dict in the config, or return None if it is
+    malformed
+    """
+    if (not isinstance(route, dict)
+            or not _has_key_of_type(route, "name", str)
+            or not _has_key_of_type(route, "model", str)):
+        return None
+
+    max_length = route.get("max_length")
+    has_code = route.get("has_code")
+    channels = route.get("channels", [])
+    intents = route.get("intents", [])
+    if (not isinstance(route.get("min_length", 0), int)
+            or not isinstance(max_length, (int, type(None)))
+            or not isinstance(has_code, (bool, type(None)))
+            or not _all_isinstance(channels, int)
+            or not _all_isinstance(intents, str)):
+        return None
+
+    return Route(
+        route["name"],
+        route["model"],
+        route.get("min_length", 0),
+        max_length,
+        has_code,
+        tuple(channels),
+        tuple(intents),
+    )
+
+
 class BotConfig:
+    """
+    A snapshot of the bot's configuration.
+    Once loaded, it is frozen, and a new snapshot replaces it when the
+    config changes, so code that keeps a reference to it sees a
+    consistent config.
+    """
+    version: int
+    """Incremented every time a new config is loaded"""
     command_prefix: str
-    greetings: list[str]
+    command_cooldown: float
+    greetings: tuple[str, ...]
     enforce_guild: bool
-    resources: list[Resource]
+    resources: tuple[Resource, ...]
+    routes: tuple[Route, ...]
+    """Tried in order, the first one that matches a mention is used"""
     bot_name: str
     llm_enabled: bool
     llm_model: str
     auto_pull_model: bool
+    llm_keep_alive: str | int
+    keep_warm_interval: float
+    keep_warm_hours: str
     history_length: int
+    history_mode: str
+    history_active_ttl: float
     system_prompt: str
+    stream_responses: bool
+    stream_edit_interval: float
+    stream_min_prefix: int
+    llm_max_concurrency: int
+    channel_queue_size: int
+    queue_overflow: str
+    user_rate_limit: float
+    user_rate_burst: int
+    channel_rate_limit: float
+    channel_rate_burst: int
+    admission_max_wait: float
+    cancel_superseded: bool
+    persist_history: bool
+    history_idle_ttl: float
+    history_memory_mb: float
+    context_token_budget: int
+    summarize_history: bool
+    summary_keep_recent: int
+    summary_min_new: int
+    summary_max_words: int
+    retrieve_context: bool
+    embedding_model: str
+    retrieval_top_k: int
+    retrieval_min_score: float
+    retrieval_max_documents: int
+    response_cache_enabled: bool
+    response_cache_size: int
+    response_cache_ttl: float
+    response_cache_context: int
+    admin_ids: tuple[int, ...]
+    loop_stall_threshold: float
 
     def __init__(self):
+        self.version = 0
         self.command_prefix = "!"
-        self.greetings = ["hello", "hi", "hey"]
+        self.command_cooldown = 5
+        self.greetings = ("hello", "hi", "hey")
         self.enforce_guild = True
-        self.resources = []
+        self.resources = ()
+        self.routes = ()
         self.bot_name = ""
         self.llm_enabled = False
         self.llm_model = "llama2"
         self.auto_pull_model = False
+        self.llm_keep_alive = "30m"
+        self.keep_warm_interval = 0
+        self.keep_warm_hours = ""
         self.history_length = 30
+        self.history_mode = "eager"
+        self.history_active_ttl = 1800
         self.system_prompt = ""
+        self.stream_responses = True
+        self.stream_edit_interval = 1.0
+        self.stream_min_prefix = 40
+        self.llm_max_concurrency = 1
+        self.channel_queue_size = 3
+        self.queue_overflow = "merge"
+        self.user_rate_limit = 4
+        self.user_rate_burst = 2
+        self.channel_rate_limit = 12
+        self.channel_rate_burst = 4
+        self.admission_max_wait = 120
+        self.cancel_superseded = False
+        self.persist_history = True
+        self.history_idle_ttl = 86400
+        self.history_memory_mb = 64
+        self.context_token_budget = 2048
+        self.summarize_history = False
+        self.summary_keep_recent = 8
+        self.summary_min_new = 8
+        self.summary_max_words = 200
+        self.retrieve_context = False
+        self.embedding_model = "nomic-embed-text"
+        self.retrieval_top_k = 3
+        self.retrieval_min_score = 0.5
+        self.retrieval_max_documents = 20000
+        self.response_cache_enabled = False
+        self.response_cache_size = 256
+        self.response_cache_ttl = 3600
+        self.response_cache_context = 0
+        self.admin_ids = ()
+        self.loop_stall_threshold = 0.5
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if self.__dict__.get("_frozen", False):
+            raise AttributeError(f"BotConfig is frozen, can't set `{name}`")
+        super().__setattr__(name, value)
+
+    def freeze(self) -> None:
+        """
+        Prevent any further changes to the config
+        """
+        self._frozen = True
 
     def load_from_file(self, f):
-        user_config = yaml.load(f, yaml.Loader)
-
-        with open(_globalconf.DEFAULT_CONFIG_FILE, "r") as default_config_file:
-            default_config = yaml.load(default_config_file, yaml.Loader)
+        """
+        Load the config from a file merged with the default config.
+        Will raise an exception if the file is invalid.
+        """
+        user_config = yaml.load(f, _Loader)
+        if user_config is not None and not isinstance(user_config, dict):
+            raise Exception("config must be a mapping of keys to values")
 
         # This will raise an exception if default_config is malformed
-        merged_config = _merge_configs(user_config, default_config)
+        merged_config = _merge_configs(user_config, _load_default_config())
 
         self.command_prefix = merged_config["command_prefix"]
-        self.greetings = merged_config["greetings"]
+        self.command_cooldown = merged_config["command_cooldown"]
+        self.greetings = tuple(merged_config["greetings"])
         self.enforce_guild = merged_config["enforce_guild"]
-        self.resources = merged_config["resources"]
+        self.resources = tuple(merged_config["resources"])
+        self.routes = tuple(merged_config["routes"])
         self.bot_name = merged_config["bot_name"]
         self.llm_enabled = merged_config["llm_enabled"]
         self.llm_model = merged_config["llm_model"]
         self.auto_pull_model = merged_config["auto_pull_model"]
+        self.llm_keep_alive = merged_config["llm_keep_alive"]
+        self.keep_warm_interval = merged_config["keep_warm_interval"]
+        self.keep_warm_hours = merged_config["keep_warm_hours"]
         self.history_length = merged_config["history_length"]
+        self.history_mode = merged_config["history_mode"]
+        self.history_active_ttl = merged_config["history_active_ttl"]
         self.system_prompt = merged_config["system_prompt"]
+        self.stream_responses = merged_config["stream_responses"]
+        self.stream_edit_interval = merged_config["stream_edit_interval"]
+        self.stream_min_prefix = merged_config["stream_min_prefix"]
+        self.llm_max_concurrency = merged_config["llm_max_concurrency"]
+        self.channel_queue_size = merged_config["channel_queue_size"]
+        self.queue_overflow = merged_config["queue_overflow"]
+        self.user_rate_limit = merged_config["user_rate_limit"]
+        self.user_rate_burst = merged_config["user_rate_burst"]
+        self.channel_rate_limit = merged_config["channel_rate_limit"]
+        self.channel_rate_burst = merged_config["channel_rate_burst"]
+        self.admission_max_wait = merged_config["admission_max_wait"]
+        self.cancel_superseded = merged_config["cancel_superseded"]
+        self.persist_history = merged_config["persist_history"]
+        self.history_idle_ttl = merged_config["history_idle_ttl"]
+        self.history_memory_mb = merged_config["history_memory_mb"]
+        self.context_token_budget = merged_config["context_token_budget"]
+        self.summarize_history = merged_config["summarize_history"]
+        self.summary_keep_recent = merged_config["summary_keep_recent"]
+        self.summary_min_new = merged_config["summary_min_new"]
+        self.summary_max_words = merged_config["summary_max_words"]
+        self.retrieve_context = merged_config["retrieve_context"]
+        self.embedding_model = merged_config["embedding_model"]
+        self.retrieval_top_k = merged_config["retrieval_top_k"]
+        self.retrieval_min_score = merged_config["retrieval_min_score"]
+        self.retrieval_max_documents = (
+            merged_config["retrieval_max_documents"]
+        )
+        self.response_cache_enabled = merged_config["response_cache_enabled"]
+        self.response_cache_size = merged_config["response_cache_size"]
+        self.response_cache_ttl = merged_config["response_cache_ttl"]
+        self.response_cache_context = merged_config["response_cache_context"]
+        self.admin_ids = tuple(merged_config["admin_ids"])
+        self.loop_stall_threshold = merged_config["loop_stall_threshold"]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Merged Config:\n{yaml.dump(merged_config)}")
 
-        logger.debug(f"Merged Config:\n{yaml.dump(merged_config)}")
 
+_default_config: Any = None
+_default_config_mtime: int | None = None
+_default_config_lock = threading.Lock()
 
-def _has_key_of_type(d: Any, k: str, t: type) -> bool:
+
+def _load_default_config() -> Any:
+    """
+    Return the parsed default config, only reading the file again if it
+    has changed
+    """
+    global _default_config, _default_config_mtime
+
+    with _default_config_lock:
+        mtime = os.stat(_globalconf.DEFAULT_CONFIG_FILE).st_mtime_ns
+        if mtime != _default_config_mtime:
+            with open(_globalconf.DEFAULT_CONFIG_FILE, "r") as f:
+                _default_config = yaml.load(f, _Loader)
+            _default_config_mtime = mtime
+        return _default_config
+
+
+def parse_config(f) -> BotConfig:
+    """
+    Load a config from a file, without making it the current config.
+    This doesn't touch the current config, so it can run on another
+    thread.
+    Will raise an exception if the file is invalid.
+    """
+    config = BotConfig()
+    config.load_from_file(f)
+    return config
+
+
+def use_config(config: BotConfig) -> BotConfig:
+    """
+    Freeze `config`, and atomically make it the current `bot_config`
+    """
+    global bot_config
+
+    config.version = bot_config.version + 1
+    config.freeze()
+    bot_config = config
+    return config
+
+
+def load_config(f) -> BotConfig:
+    """
+    Load a config from a file, and make it the current `bot_config`.
+    Will raise an exception, and keep the current config, if the file
+    is invalid.
+    """
+    return use_config(parse_config(f))
+
+
+def _has_key_of_type(d: Any, k: str, t: type | tuple[type, ...]) -> bool:
     """
     Check if a dict `d` has a key `k` of type `t`
     """
@@ -95,6 +372,27 @@ def _all_isinstance(lst: Any, t: type) -> bool:
     return True
 
 
+def _merge_key(
+    user_config: Any,
+    default_config: Any,
+    merged_config: dict[Any, Any],
+    k: str,
+    t: type | tuple[type, ...],
+) -> None:
+    """
+    Set `merged_config[k]` to the value of `k` in `user_config` if it
+    is of type `t`, otherwise to the value in `default_config`.
+    Will raise an exception if default_config is
+    missing the key, or the value is of the wrong type
+    """
+    if not _has_key_of_type(default_config, k, t):
+        raise Exception(f"default_config is missing a key `{k}`")
+    if _has_key_of_type(user_config, k, t):
+        merged_config[k] = user_config[k]
+    else:
+        merged_config[k] = default_config[k]
+
+
 def _merge_configs(user_config: Any, default_config: Any) -> dict[Any, Any]:
     """
     Will raise an exception if default_config is
@@ -109,12 +407,11 @@ def _merge_configs(user_config: Any, default_config: Any) -> dict[Any, Any]:
 
     merged_config = {}
 
-    if not _has_key_of_type(default_config, "command_prefix", str):
-        raise Exception("default_config is missing a key `command_prefix`")
-    if _has_key_of_type(user_config, "command_prefix", str):
-        merged_config["command_prefix"] = user_config["command_prefix"]
-    else:
-        merged_config["command_prefix"] = default_config["command_prefix"]
+    _merge_key(user_config, default_config, merged_config,
+               "command_prefix", str)
+
+    _merge_key(user_config, default_config, merged_config,
+               "command_cooldown", (int, float))
 
     if not ("greetings" in default_config and
             _all_isinstance(default_config["greetings"], str)):
@@ -125,12 +422,8 @@ def _merge_configs(user_config: Any, default_config: Any) -> dict[Any, Any]:
     else:
         merged_config["greetings"] = default_config["greetings"]
 
-    if not _has_key_of_type(default_config, "enforce_guild", bool):
-        raise Exception("default_config is missing a key `enforce_guild`")
-    if _has_key_of_type(user_config, "enforce_guild", bool):
-        merged_config["enforce_guild"] = user_config["enforce_guild"]
-    else:
-        merged_config["enforce_guild"] = default_config["enforce_guild"]
+    _merge_key(user_config, default_config, merged_config,
+               "enforce_guild", bool)
 
     merged_config["resources"] = []
     if not _has_key_of_type(default_config, "resources", list):
@@ -160,40 +453,159 @@ def _merge_configs(user_config: Any, default_config: Any) -> dict[Any, Any]:
                 Resource(res["name"], res["link"], res["desc"])
             )
 
-    if not _has_key_of_type(default_config, "bot_name", str):
-        raise Exception("default_config is missing a key `bot_name`")
-    if _has_key_of_type(user_config, "bot_name", str):
-        merged_config["bot_name"] = user_config["bot_name"]
-    else:
-        merged_config["bot_name"] = default_config["bot_name"]
+    if not _has_key_of_type(default_config, "routes", list):
+        raise Exception("default_config is missing a key `routes`")
+    routes = (
+        user_config["routes"]
+        if _has_key_of_type(user_config, "routes", list)
+        else default_config["routes"]
+    )
+    merged_config["routes"] = []
+    for r in routes:
+        route = _parse_route(r)
+        if route is None:
+            logger.warning(f"Malformed route: {r}")
+            continue
+        merged_config["routes"].append(route)
 
-    if not _has_key_of_type(default_config, "llm_enabled", bool):
-        raise Exception("default_config is missing a key `llm_enabled`")
-    if _has_key_of_type(user_config, "llm_enabled", bool):
-        merged_config["llm_enabled"] = user_config["llm_enabled"]
-    else:
-        merged_config["llm_enabled"] = default_config["llm_enabled"]
+    _merge_key(user_config, default_config, merged_config,
+               "bot_name", str)
 
-    if not _has_key_of_type(default_config, "llm_model", str):
-        raise Exception("default_config is missing a key `llm_model`")
-    if _has_key_of_type(user_config, "llm_model", str):
-        merged_config["llm_model"] = user_config["llm_model"]
-    else:
-        merged_config["llm_model"] = default_config["llm_model"]
+    _merge_key(user_config, default_config, merged_config,
+               "llm_enabled", bool)
 
-    if not _has_key_of_type(default_config, "auto_pull_model", bool):
-        raise Exception("default_config is missing a key `auto_pull_model`")
-    if _has_key_of_type(user_config, "auto_pull_model", bool):
-        merged_config["auto_pull_model"] = user_config["auto_pull_model"]
-    else:
-        merged_config["auto_pull_model"] = default_config["auto_pull_model"]
+    _merge_key(user_config, default_config, merged_config,
+               "llm_model", str)
+
+    _merge_key(user_config, default_config, merged_config,
+               "auto_pull_model", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "llm_keep_alive", (str, int))
+
+    _merge_key(user_config, default_config, merged_config,
+               "keep_warm_interval", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "keep_warm_hours", str)
+
+    _merge_key(user_config, default_config, merged_config,
+               "history_length", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "history_mode", str)
+    if merged_config["history_mode"] not in ("eager", "lazy"):
+        logger.warning(
+            f"Invalid history_mode: {merged_config['history_mode']}"
+        )
+        merged_config["history_mode"] = default_config["history_mode"]
+
+    _merge_key(user_config, default_config, merged_config,
+               "history_active_ttl", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "persist_history", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "history_idle_ttl", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "history_memory_mb", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "context_token_budget", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "summarize_history", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "summary_keep_recent", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "summary_min_new", int)
 
-    if not _has_key_of_type(default_config, "history_length", int):
-        raise Exception("default_config is missing a key `history_length`")
-    if _has_key_of_type(user_config, "history_length", int):
-        merged_config["history_length"] = user_config["history_length"]
+    _merge_key(user_config, default_config, merged_config,
+               "summary_max_words", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "retrieve_context", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "embedding_model", str)
+
+    _merge_key(user_config, default_config, merged_config,
+               "retrieval_top_k", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "retrieval_min_score", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "retrieval_max_documents", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "response_cache_enabled", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "response_cache_size", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "response_cache_ttl", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "response_cache_context", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "stream_responses", bool)
+
+    _merge_key(user_config, default_config, merged_config,
+               "stream_edit_interval", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "stream_min_prefix", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "llm_max_concurrency", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "channel_queue_size", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "queue_overflow", str)
+    if merged_config["queue_overflow"] not in ("merge", "drop"):
+        logger.warning(
+            f"Invalid queue_overflow: {merged_config['queue_overflow']}"
+        )
+        merged_config["queue_overflow"] = default_config["queue_overflow"]
+
+    _merge_key(user_config, default_config, merged_config,
+               "user_rate_limit", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "user_rate_burst", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "channel_rate_limit", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "channel_rate_burst", int)
+
+    _merge_key(user_config, default_config, merged_config,
+               "admission_max_wait", (int, float))
+
+    _merge_key(user_config, default_config, merged_config,
+               "cancel_superseded", bool)
+
+    if not ("admin_ids" in default_config and
+            _all_isinstance(default_config["admin_ids"], int)):
+        raise Exception("default_config is missing a key `admin_ids`")
+    if ("admin_ids" in user_config
+            and _all_isinstance(user_config["admin_ids"], int)):
+        merged_config["admin_ids"] = user_config["admin_ids"]
     else:
-        merged_config["history_length"] = default_config["history_length"]
+        merged_config["admin_ids"] = default_config["admin_ids"]
+
+    _merge_key(user_config, default_config, merged_config,
+               "loop_stall_threshold", (int, float))
 
     other_prompt = (
         # FIXME: This is a bad place to put the information about commands
@@ -226,3 +638,4 @@ def _merge_configs(user_config: Any, default_config: Any) -> dict[Any, Any]:
 
 
 bot_config = BotConfig()
+bot_config.freeze()
@@ -1,14 +1,528 @@
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+import sqlite3
+import sys
+import time
+
 import discord
 
 from . import botconf as _botconf
+from . import context as _context
+from . import histstore as _histstore
+from . import metrics as _metrics
+
+logger = logging.getLogger(__name__)
+
+BUSY_NOTICE = "I'm busy, try again in "
+"""Beginning of the reply to a mention that is refused"""
+PULL_NOTICE = "I'm still downloading my model "
+"""Beginning of the reply to a mention whose model is being pulled"""
+_NOTICES = (BUSY_NOTICE, PULL_NOTICE)
+"""Beginnings of the bot's notices, which aren't part of the history"""
+
+
+class HistoryEntry:
+    """
+    A single message in a channel's history
+    """
+    __slots__ = (
+        "role", "author_id", "message_id", "content", "timestamp", "tokens",
+        "encoded",
+    )
+
+    role: str
+    """Either "user" or "assistant\""""
+    author_id: int | None
+    message_id: int | None
+    """The (first) Discord message the entry was made from"""
+    content: str
+    timestamp: float
+    """When the message was created, as a UNIX timestamp"""
+    tokens: int
+    """Estimated number of tokens the entry takes in the prompt"""
+    encoded: bytes
+    """The entry as a JSON message, encoded once so building a request
+    doesn't encode the whole history again"""
+
+    def __init__(
+        self,
+        role: str,
+        author_id: int | None,
+        message_id: int | None,
+        content: str,
+        timestamp: float,
+    ) -> None:
+        self.role = role
+        self.author_id = author_id
+        self.message_id = message_id
+        self.content = content
+        self.timestamp = timestamp
+        self.tokens = _context.estimate_tokens(content)
+        self.encoded = _context.dumps(self.to_dict())
+
+    def to_dict(self) -> dict[str, str]:
+        """
+        Convert the entry into a message to send to the LLM
+        """
+        return {"role": self.role, "content": self.content}
+
+    @property
+    def size(self) -> int:
+        """Approximate memory used by the entry, in bytes"""
+        return (
+            _ENTRY_SIZE +
+            sys.getsizeof(self.content) +
+            sys.getsizeof(self.encoded)
+        )
+
+
+_ENTRY_SIZE = sys.getsizeof(HistoryEntry("user", 0, 0, "", 0.0))
+
+
+class Summary:
+    """
+    A condensed version of the older part of a channel's history
+    """
+    __slots__ = ("content", "upto", "tokens")
+
+    content: str
+    upto: float
+    """Timestamp of the newest entry included in the summary"""
+    tokens: int
+    """Estimated number of tokens the summary takes in the prompt"""
+
+    def __init__(self, content: str, upto: float) -> None:
+        self.content = content
+        self.upto = upto
+        self.tokens = _context.estimate_tokens(content)
+
+
+class ChannelHistory:
+    """
+    The last `history_length` messages of a channel, in a ring buffer
+    """
+    __slots__ = ("entries", "size", "last_used", "appended")
+
+    entries: deque[HistoryEntry]
+    size: int
+    """Approximate memory used by the entries, in bytes"""
+    last_used: float
+    """`time.monotonic()` of when the history was last touched"""
+    appended: int
+    """Number of entries ever appended"""
+
+    def __init__(self, max_len: int) -> None:
+        self.entries = deque(maxlen=max_len)
+        self.size = 0
+        self.last_used = time.monotonic()
+        self.appended = 0
+
+    def append(self, entry: HistoryEntry) -> int:
+        """
+        Append an entry, dropping the oldest one if the history is full.
+        Return the change in size.
+        """
+        delta = entry.size
+        if len(self.entries) == self.entries.maxlen:
+            delta -= self.entries[0].size
+        self.entries.append(entry)
+        self.size += delta
+        self.appended += 1
+        return delta
+
+    def replace(
+        self,
+        message_id: int,
+        entry: HistoryEntry | None,
+    ) -> int | None:
+        """
+        Replace the entry made from a message with `entry`, or remove
+        it if `entry` is None.
+        Return the change in size, or None if there was no such entry.
+        """
+        for i, old in enumerate(self.entries):
+            if old.message_id == message_id:
+                break
+        else:
+            return None
+
+        if entry is None:
+            del self.entries[i]
+            delta = -old.size
+        else:
+            self.entries[i] = entry
+            delta = entry.size - old.size
+        self.size += delta
+        return delta
+
+    def resize(self, max_len: int) -> int:
+        """
+        Change the maximum length of the history.
+        Return the change in size.
+        """
+        old_size = self.size
+        self.entries = deque(self.entries, maxlen=max_len)
+        self.size = sum(e.size for e in self.entries)
+        return self.size - old_size
 
 
 class MessageHistory:
-    message_histories: dict[int, list[dict[str, str]]]
-    """A dictionary that associates channel IDs to their histories"""
+    """
+    The recent message history of every channel.
+
+    Channels that haven't been used for `history_idle_ttl` seconds are
+    evicted, and if the history uses more than `history_memory_mb`
+    megabytes, the least recently used channels are evicted until it
+    fits. Evicted channels are reloaded from the store (if any) the
+    next time they are warmed.
+
+    In the `lazy` `history_mode`, channels are only recorded while they
+    are active, i.e. for `history_active_ttl` seconds after the bot was
+    last mentioned in them. When the bot is mentioned in an inactive
+    channel, its recent messages are fetched from Discord instead.
+    """
+    message_histories: OrderedDict[int, ChannelHistory]
+    """
+    A dictionary that associates channel IDs to their histories,
+    from least to most recently used
+    """
+    store: _histstore.HistoryStore | None
+    """Where the history is persisted, if anywhere"""
+    size: int
+    """Approximate memory used by all the histories, in bytes"""
+    evictions: int
+    """Number of channels evicted so far"""
+    summaries: dict[int, Summary]
+    """
+    The summary of each channel in memory that has one, loaded and
+    evicted along with the channel's entries
+    """
+    archive_listeners: list[Callable[[int, HistoryEntry], None]]
+    """
+    Called with the channel ID and the entry, when an entry is dropped
+    from a channel's history to make room for a new one
+    """
 
     def __init__(self) -> None:
-        self.message_histories = {}
+        self.message_histories = OrderedDict()
+        self.store = None
+        self.size = 0
+        self.evictions = 0
+        self.summaries = {}
+        self.archive_listeners = []
+        self._warmed: set[int] = set()
+        """Channels whose history has been loaded from the store"""
+        self._warming: dict[int, asyncio.Task[None]] = {}
+        self._active: dict[int, float] = {}
+        """When the bot was last mentioned in each active channel"""
+        self._backfilling: dict[int, asyncio.Task[None]] = {}
+
+    async def open_store(self, path: str) -> None:
+        """
+        Start persisting the history to the SQLite database at `path`.
+        Each channel's history and summary are loaded from the database
+        the first time `warm` is called for it.
+        """
+        if self.store is None:
+            self.store = _histstore.HistoryStore(path)
+        await self.store.open()
+
+    async def close_store(self) -> None:
+        if self.store is not None:
+            await self.store.close()
+
+    def entries(self, chan_id: int) -> deque[HistoryEntry]:
+        """
+        Return a channel's history entries, from oldest to newest
+        """
+        channel = self.message_histories.get(chan_id)
+        if channel is None:
+            return deque()
+        return channel.entries
+
+    def summary(self, chan_id: int) -> Summary | None:
+        return self.summaries.get(chan_id)
+
+    async def set_summary(
+        self,
+        chan_id: int,
+        content: str,
+        upto: float,
+    ) -> None:
+        """
+        Replace the summary of a channel with one that includes every
+        entry up to the timestamp `upto`
+        """
+        # A channel evicted while it was being summarized gets its
+        # summary from the store when it comes back
+        if chan_id in self.message_histories:
+            self.summaries[chan_id] = Summary(content, upto)
+        if self.store is not None:
+            await self.store.save_summary(chan_id, content, upto)
+
+    def memory_stats(self) -> dict[str, Any]:
+        """
+        Return statistics about the memory used by the histories
+        """
+        return {
+            "channels": len(self.message_histories),
+            "entries": sum(
+                len(c.entries) for c in self.message_histories.values()
+            ),
+            "bytes": self.size,
+            "budget_bytes": _memory_budget(),
+            "evictions": self.evictions,
+        }
+
+    async def warm(self, chan_id: int) -> None:
+        """
+        Load a channel's persisted history, if it hasn't been already.
+        Messages added to the channel before it was warmed are kept
+        after the loaded ones.
+        """
+        if self.store is None or chan_id in self._warmed:
+            return
+
+        # Concurrent callers wait for the same load
+        task = self._warming.get(chan_id)
+        if task is None:
+            task = asyncio.create_task(self._load(chan_id))
+            self._warming[chan_id] = task
+        await asyncio.shield(task)
+
+    async def _load(self, chan_id: int) -> None:
+        try:
+            # Try again next time if the store couldn't be read
+            if await self._fill(chan_id, self._read_store):
+                self._warmed.add(chan_id)
+        finally:
+            del self._warming[chan_id]
+
+    async def _read_store(self, chan_id: int) -> list[HistoryEntry] | None:
+        """
+        Return a channel's persisted entries, or None if they couldn't be
+        read
+        """
+        if self.store is None:
+            return []
+
+        try:
+            rows = await self.store.load(
+                chan_id,
+                _botconf.bot_config.history_length,
+            )
+        except sqlite3.Error as e:
+            logger.error(f"{type(e)}: {e}")
+            return None
+        if not await self._load_summary(chan_id):
+            return None
+
+        return [
+            HistoryEntry(role, author_id, message_id, content, created_at)
+            for _, message_id, author_id, role, content, created_at in rows
+        ]
+
+    async def _load_summary(self, chan_id: int) -> bool:
+        """
+        Load a channel's persisted summary, unless it already has one in
+        memory.
+        Return whether the store could be read.
+        """
+        if self.store is None or chan_id in self.summaries:
+            return True
+
+        try:
+            row = await self.store.load_summary(chan_id)
+        except sqlite3.Error as e:
+            logger.error(f"{type(e)}: {e}")
+            return False
+
+        if row is not None:
+            self.summaries[chan_id] = Summary(*row)
+        return True
+
+    async def _fill(
+        self,
+        chan_id: int,
+        fetch: Callable[[int], Awaitable[list[HistoryEntry] | None]],
+    ) -> bool:
+        """
+        Replace a channel's history with the entries returned by
+        `fetch`, keeping the entries added while fetching after them.
+        If `fetch` returns None, the history is left as it is.
+        Return whether the history was replaced.
+        """
+        # Messages added before fetching are written to the store
+        # before it is read, and are older than the ones fetched from
+        # Discord, so only the ones added while fetching need to be kept
+        channel = self._channel(chan_id)
+        before = channel.appended
+        entries = await fetch(chan_id)
+        if entries is None:
+            return False
+
+        channel = self._channel(chan_id)
+        added = min(channel.appended - before, len(channel.entries))
+        kept = list(channel.entries)[len(channel.entries) - added:]
+
+        self.size -= channel.size
+        channel.entries.clear()
+        channel.size = 0
+        for entry in entries:
+            self.size += channel.append(entry)
+        for entry in kept:
+            self.size += channel.append(entry)
+
+        self._evict(chan_id)
+        return True
+
+    def is_active(self, chan_id: int) -> bool:
+        """
+        Check whether a channel's messages are being recorded in the
+        `lazy` `history_mode`
+        """
+        mentioned_at = self._active.get(chan_id)
+        if mentioned_at is None:
+            return False
+
+        ttl = _botconf.bot_config.history_active_ttl
+        if ttl > 0 and time.monotonic() - mentioned_at > ttl:
+            # The history is missing messages from now on, so it has
+            # to be fetched again when the bot is next mentioned
+            del self._active[chan_id]
+            return False
+        return True
+
+    async def backfill(
+        self,
+        message: discord.Message,
+        bot_user: Any,
+    ) -> None:
+        """
+        Make the channel of a message that mentioned the bot active, and
+        fetch its messages before `message` from Discord if it wasn't.
+        Concurrent callers for the same channel wait for the same fetch.
+        `bot_user` is the bot's user, whose replies are assistant
+        messages.
+        """
+        chan_id = message.channel.id
+        active = self.is_active(chan_id)
+        self._active[chan_id] = time.monotonic()
+        if active and chan_id not in self._backfilling:
+            return
+
+        task = self._backfilling.get(chan_id)
+        if task is None:
+            task = asyncio.create_task(
+                self._backfill(message, bot_user)
+            )
+            self._backfilling[chan_id] = task
+        await asyncio.shield(task)
+
+    async def _backfill(self, message: discord.Message, bot_user: Any) -> None:
+        chan_id = message.channel.id
+        started = time.monotonic()
+
+        async def fetch(chan_id: int) -> list[HistoryEntry]:
+            config = _botconf.bot_config
+            # Lists of messages that make a single entry, like
+            # `add_message` gets them
+            groups: list[list[discord.Message]] = []
+            # The message replied to by the last group, if it is a reply
+            # of the bot
+            replied_to: int | None = None
+            try:
+                async for m in message.channel.history(
+                    limit=config.history_length,
+                    before=message,
+                ):
+                    is_bot = m.author == bot_user
+                    # Skip commands, and the bot's answers to them
+                    if m.content.startswith(config.command_prefix):
+                        continue
+                    reference = getattr(m, "reference", None)
+                    if is_bot and (reference is None
+                                   or m.content.startswith(_NOTICES)):
+                        continue
+
+                    if not is_bot:
+                        groups.append([m])
+                        replied_to = None
+                    elif (replied_to is not None
+                            and replied_to == reference.message_id):
+                        # Another page of the same reply. Discord
+                        # returns the newest messages first.
+                        groups[-1].insert(0, m)
+                    else:
+                        groups.append([m])
+                        replied_to = reference.message_id
+            except discord.HTTPException as e:
+                logger.error(f"{type(e)}: {e}")
+                _metrics.errors.inc(stage="backfill")
+            groups.reverse()
+            return [_make_entry(g, g[0].author == bot_user) for g in groups]
+
+        try:
+            await self._load_summary(chan_id)
+            await self._fill(chan_id, fetch)
+        finally:
+            del self._backfilling[chan_id]
+
+        _metrics.history_backfill.observe(time.monotonic() - started)
+        logger.info(f"backfilled history of channel {chan_id}")
+
+    def _channel(self, chan_id: int) -> ChannelHistory:
+        """
+        Get a channel's history, creating it if needed, and mark it as
+        the most recently used
+        """
+        hist_len = _botconf.bot_config.history_length
+        channel = self.message_histories.get(chan_id)
+        if channel is None:
+            channel = ChannelHistory(hist_len)
+            self.message_histories[chan_id] = channel
+        else:
+            self.message_histories.move_to_end(chan_id)
+            if channel.entries.maxlen != hist_len:
+                self.size += channel.resize(hist_len)
+
+        channel.last_used = time.monotonic()
+        return channel
+
+    def _evict(self, keep: int) -> None:
+        """
+        Evict the least recently used channels while they are idle, or
+        while the histories don't fit in the memory budget.
+        The channel `keep` is never evicted.
+        """
+        ttl = _botconf.bot_config.history_idle_ttl
+        budget = _memory_budget()
+        deadline = time.monotonic() - ttl
+
+        # The histories are ordered from least to most recently used,
+        # so only the first ones need to be checked
+        while len(self.message_histories) > 0:
+            chan_id, channel = next(iter(self.message_histories.items()))
+            if chan_id == keep:
+                break
+
+            idle = ttl > 0 and channel.last_used < deadline
+            over_budget = budget > 0 and self.size > budget
+            if not idle and not over_budget:
+                break
+
+            self._evict_channel(chan_id)
+
+    def _evict_channel(self, chan_id: int) -> None:
+        channel = self.message_histories.pop(chan_id)
+        self.size -= channel.size
+        self.summaries.pop(chan_id, None)
+        self._warmed.discard(chan_id)
+        self._active.pop(chan_id, None)
+        self.evictions += 1
+        logger.debug("evicted history of channel %d", chan_id)
 
     # NOTE: This method can add messages out of order
     def add_message(
@@ -18,11 +532,10 @@ class MessageHistory:
     ) -> None:
         """
         Concatenate the contents of a list of messages into a
-        single dictionary, and add it to the history.
-        The resulting message dictionary will be added to the
-        history of the first message's channel.
-        The channel's message history will then be truncated
-        to the length specified by `history_length` in the
+        single entry, and add it to the history.
+        The resulting entry will be added to the
+        history of the first message's channel, which keeps
+        the last `history_length` entries, as specified in the
         bot's config.
         If `is_bot` is True, the message's role will be
         "assistant", otherwise it will be "user".
@@ -36,31 +549,92 @@ class MessageHistory:
         if len(message_list) < 1:
             return
 
-        author = message_list[0].author
-        content = (
-            # Add author name and mention to content if it is not a bot
-            "" if is_bot else f"({author.display_name} {author.mention}) "
+        entry = _make_entry(message_list, is_bot)
+
+        chan_id = message_list[0].channel.id
+        channel = self._channel(chan_id)
+        dropped = (
+            channel.entries[0]
+            if len(channel.entries) == channel.entries.maxlen else None
         )
-        content += " ".join([m.content for m in message_list])
+        self.size += channel.append(entry)
+        self._evict(chan_id)
 
-        # Create message dict
-        msg_dict = {
-            "role": "assistant" if is_bot else "user",
-            "content": content,
-        }
+        if dropped is not None:
+            for listener in self.archive_listeners:
+                listener(chan_id, dropped)
 
-        chan_id = message_list[0].channel.id
-        hist_len = _botconf.bot_config.history_length
-        if chan_id in self.message_histories:
-            self.message_histories[chan_id].append(msg_dict)
-            if len(self.message_histories[chan_id]) > hist_len:
-                # Truncate the channel's history to the last
-                # `history_length` messages
-                self.message_histories[chan_id] = (
-                    self.message_histories[chan_id][-hist_len:]
-                )
-        else:
-            self.message_histories[chan_id] = [msg_dict]
+        if self.store is not None:
+            self.store.append(
+                chan_id,
+                entry.message_id,
+                entry.author_id,
+                entry.role,
+                entry.content,
+                entry.timestamp,
+            )
+
+    async def remove_message(self, chan_id: int, message_id: int) -> None:
+        """
+        Remove the entry made from a message, e.g. because it was deleted
+        """
+        channel = self.message_histories.get(chan_id)
+        if channel is not None:
+            delta = channel.replace(message_id, None)
+            if delta is not None:
+                self.size += delta
+
+        if self.store is not None:
+            await self.store.delete(chan_id, message_id)
+
+    async def edit_message(
+        self,
+        message: discord.Message,
+        is_bot: bool = False,
+    ) -> None:
+        """
+        Update the entry made from a message that was edited
+        """
+        entry = _make_entry([message], is_bot)
+        chan_id = message.channel.id
+
+        channel = self.message_histories.get(chan_id)
+        if channel is not None:
+            delta = channel.replace(message.id, entry)
+            if delta is not None:
+                self.size += delta
+
+        if self.store is not None:
+            await self.store.update(chan_id, message.id, entry.content)
+
+
+def _make_entry(
+    message_list: list[discord.Message],
+    is_bot: bool,
+) -> HistoryEntry:
+    """
+    Make a history entry from a non-empty list of messages, as described
+    in `MessageHistory.add_message`
+    """
+    author = message_list[0].author
+    content = (
+        # Add author name and mention to content if it is not a bot
+        "" if is_bot else f"({author.display_name} {author.mention}) "
+    )
+    content += " ".join([m.content for m in message_list])
+
+    return HistoryEntry(
+        "assistant" if is_bot else "user",
+        author.id,
+        message_list[0].id,
+        content,
+        message_list[0].created_at.timestamp(),
+    )
+
+
+def _memory_budget() -> int:
+    """The memory budget of the histories in bytes, 0 if unlimited"""
+    return int(_botconf.bot_config.history_memory_mb * 1024 * 1024)
 
 
 bot_history = MessageHistory()
@@ -0,0 +1,320 @@
+"""
+Commands that can be run by sending a message starting with the
+`command_prefix`
+"""
+
+from typing import Awaitable, Callable
+import io
+import logging
+import math
+import re
+import time
+
+import discord
+
+from . import botconf as _botconf
+from . import diagnostics as _diagnostics
+from . import metrics as _metrics
+from . import modelpull as _modelpull
+
+logger = logging.getLogger(__name__)
+
+CommandFunc = Callable[
+    [list[str], discord.Message, _botconf.BotConfig],
+    Awaitable[str | None],
+]
+"""
+Runs a command with its arguments, the message that ran it and the
+current config.
+Returns the response to send, or None if it sent its own response.
+"""
+
+MAX_PROFILE_SECONDS = 60.0
+
+
+class Command:
+    name: str
+    aliases: tuple[str, ...]
+    help: str
+    """Shown in the help message"""
+    cooldown: float | None
+    """
+    Seconds before the command can be run again in the same channel,
+    or None to use the `command_cooldown` of the config
+    """
+    admin: bool
+    """Whether only admins can run the command"""
+    run: CommandFunc
+
+    def __init__(
+        self,
+        name: str,
+        aliases: tuple[str, ...],
+        help: str,
+        cooldown: float | None,
+        admin: bool,
+        run: CommandFunc,
+    ) -> None:
+        self.name = name
+        self.aliases = aliases
+        self.help = help
+        self.cooldown = cooldown
+        self.admin = admin
+        self.run = run
+
+
+class CommandRegistry:
+    """
+    Looks up commands by name or alias, and runs them
+    """
+    commands: list[Command]
+    """Commands in the order they are shown in the help message"""
+
+    def __init__(self) -> None:
+        self.commands = []
+        self._lookup: dict[str, Command] = {}
+        self._last_run: dict[tuple[str, int], float] = {}
+        self._rendered: dict[str, tuple[int, str]] = {}
+
+    def register(
+        self,
+        name: str,
+        *aliases: str,
+        help: str,
+        cooldown: float | None = None,
+        admin: bool = False,
+    ) -> Callable[[CommandFunc], CommandFunc]:
+        """
+        Decorator to add a command
+        """
+        def decorator(run: CommandFunc) -> CommandFunc:
+            command = Command(name, aliases, help, cooldown, admin, run)
+            for n in (name, *aliases):
+                if n in self._lookup:
+                    raise ValueError(f"command `{n}` is already registered")
+                self._lookup[n] = command
+            self.commands.append(command)
+            return run
+        return decorator
+
+    def get(self, name: str) -> Command | None:
+        return self._lookup.get(name.lower())
+
+    def rendered(
+        self,
+        key: str,
+        config: _botconf.BotConfig,
+        render: Callable[[_botconf.BotConfig], str],
+    ) -> str:
+        """
+        Return the text rendered by `render` for this version of the
+        config, only rendering it again when the config changes
+        """
+        cached = self._rendered.get(key)
+        if cached is not None and cached[0] == config.version:
+            return cached[1]
+
+        text = render(config)
+        self._rendered[key] = (config.version, text)
+        return text
+
+    async def dispatch(
+        self,
+        text: str,
+        message: discord.Message,
+        config: _botconf.BotConfig,
+    ) -> None:
+        """
+        Run the command in `text`, which starts with the command prefix
+        """
+        split_text = text.strip(" \t\n").split()
+        if len(split_text) == 0:
+            return
+        name = split_text[0][len(config.command_prefix):]
+        args = split_text[1:]
+
+        command = self.get(name)
+        key = command.name if command is not None else ""
+        if self._on_cooldown(command, message.channel.id, config):
+            _metrics.commands.inc(command=key, outcome="cooldown")
+            return
+
+        if command is None:
+            _metrics.commands.inc(command=key, outcome="unknown")
+            response: str | None = (
+                f"Unknown command. Type `{config.command_prefix}help` " +
+                "for help"
+            )
+        elif command.admin and not is_admin(message, config):
+            _metrics.commands.inc(command=key, outcome="denied")
+            response = "Only admins can run this command"
+        else:
+            _metrics.commands.inc(command=key, outcome="ran")
+            response = await command.run(args, message, config)
+
+        if response is not None:
+            await message.channel.send(response, suppress_embeds=True)
+
+    def _on_cooldown(
+        self,
+        command: Command | None,
+        channel_id: int,
+        config: _botconf.BotConfig,
+    ) -> bool:
+        """
+        Check whether `command` was run in the channel too recently, and
+        if not, record that it is being run now.
+        Unknown commands (`command` is None) share a cooldown.
+        """
+        cooldown = config.command_cooldown
+        if command is not None and command.cooldown is not None:
+            cooldown = command.cooldown
+        if cooldown <= 0:
+            return False
+
+        now = time.monotonic()
+        key = (command.name if command is not None else "", channel_id)
+        last = self._last_run.get(key)
+        if last is not None and now - last < cooldown:
+            return True
+
+        if len(self._last_run) >= 1024:
+            # Forget cooldowns that are long over
+            self._last_run = {
+                k: t for k, t in self._last_run.items() if now - t < 3600
+            }
+        self._last_run[key] = now
+        return False
+
+
+def is_admin(message: discord.Message, config: _botconf.BotConfig) -> bool:
+    if message.author.id in config.admin_ids:
+        return True
+
+    # Only members of a guild have permissions
+    permissions = getattr(message.author, "guild_permissions", None)
+    return permissions is not None and permissions.administrator
+
+
+_greeting_matcher: tuple[int, re.Pattern[str] | None] = (-1, None)
+
+
+def greeting_matcher(config: _botconf.BotConfig) -> re.Pattern[str] | None:
+    """
+    Return a pattern that matches any of the greetings at the start of
+    a message (ignoring case), compiled once per version of the config,
+    or None if there are no greetings
+    """
+    global _greeting_matcher
+
+    version, matcher = _greeting_matcher
+    if version == config.version:
+        return matcher
+
+    if len(config.greetings) == 0:
+        matcher = None
+    else:
+        # Longest first, so the longest greeting wins
+        greetings = sorted(config.greetings, key=len, reverse=True)
+        matcher = re.compile(
+            "|".join(re.escape(g) for g in greetings),
+            re.IGNORECASE,
+        )
+    _greeting_matcher = (config.version, matcher)
+    return matcher
+
+
+registry = CommandRegistry()
+
+
+def _render_help(config: _botconf.BotConfig) -> str:
+    pre = config.command_prefix
+    name_width = max(len(pre + c.name) for c in registry.commands) + 2
+    alias_width = max(
+        len(pre + c.aliases[0]) if len(c.aliases) > 0 else 0
+        for c in registry.commands
+    )
+
+    lines = []
+    for c in registry.commands:
+        alias = pre + c.aliases[0] if len(c.aliases) > 0 else ""
+        desc = c.help + (" (admins only)" if c.admin else "")
+        lines.append(
+            f"{pre + c.name:<{name_width}}{alias:<{alias_width}}  -  {desc}"
+        )
+    return "```\n" + "\n".join(lines) + "\n```"
+
+
+def _render_resources(config: _botconf.BotConfig) -> str:
+    if len(config.resources) == 0:
+        return "There are currently no resources"
+    return "".join("- " + str(r) + "\n" for r in config.resources)
+
+
+@registry.register("help", "h", help="show this help message")
+async def _help(
+    args: list[str],
+    message: discord.Message,
+    config: _botconf.BotConfig,
+) -> str | None:
+    return registry.rendered("help", config, _render_help)
+
+
+@registry.register("resources", "r", help="list resources")
+async def _resources(
+    args: list[str],
+    message: discord.Message,
+    config: _botconf.BotConfig,
+) -> str | None:
+    return registry.rendered("resources", config, _render_resources)
+
+
+@registry.register("model", "m", help="show the models and download progress")
+async def _model(
+    args: list[str],
+    message: discord.Message,
+    config: _botconf.BotConfig,
+) -> str | None:
+    routes = "".join(
+        f"Route `{r.name}`: `{r.model}`\n" for r in config.routes
+    )
+    return (
+        f"Model: `{config.llm_model}`\n" + routes +
+        _modelpull.model_puller.summary()
+    )
+
+
+@registry.register(
+    "profile",
+    help="profile the bot for some seconds",
+    cooldown=0,
+    admin=True,
+)
+async def _profile(
+    args: list[str],
+    message: discord.Message,
+    config: _botconf.BotConfig,
+) -> str | None:
+    """
+    Profile the bot for a number of seconds given in `args`, and send
+    the report as a file
+    """
+    if _diagnostics.profiler.running:
+        return "Already profiling"
+
+    try:
+        seconds = float(args[0]) if len(args) > 0 else 10.0
+        if not math.isfinite(seconds):
+            raise ValueError()
+    except ValueError:
+        return f"Invalid number of seconds: {args[0]}"
+    seconds = min(max(seconds, 1.0), MAX_PROFILE_SECONDS)
+
+    logger.info(f"profiling for {seconds}s")
+    await message.channel.send(f"Profiling for {seconds}s...")
+    report = await _diagnostics.profiler.run(seconds)
+    await message.channel.send(file=discord.File(
+        io.BytesIO(report.encode()),
+        filename="profile.txt",
+    ))
+    return None
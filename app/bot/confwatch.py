@@ -0,0 +1,109 @@
+"""
+Reloading of the config when its file changes
+"""
+
+from typing import Callable
+import asyncio
+import logging
+import os
+
+import globalconf as _globalconf
+from . import botconf as _botconf
+from . import metrics as _metrics
+
+logger = logging.getLogger(__name__)
+
+Mtimes = tuple[int | None, int | None]
+
+
+def _mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ConfigWatcher:
+    """
+    Polls the modification times of the config files every
+    `CONFIG_POLL_INTERVAL` seconds, and loads the config again when
+    they change.
+    The files are read and parsed on another thread, so the event loop
+    isn't blocked. An invalid config is logged and ignored, keeping the
+    current one.
+    """
+    listeners: list[Callable[[_botconf.BotConfig, _botconf.BotConfig], None]]
+    """Called with the old and the new config after every reload"""
+
+    def __init__(self) -> None:
+        self.listeners = []
+        self._mtimes: Mtimes = (None, None)
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        """
+        Start watching the config files, assuming the current config
+        was loaded from them.
+        Does nothing if they are already being watched, or if polling
+        is disabled.
+        """
+        if self._task is not None and not self._task.done():
+            return
+        if _globalconf.CONFIG_POLL_INTERVAL <= 0:
+            return
+
+        self._mtimes = self._read_mtimes()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def check(self) -> bool:
+        """
+        Load the config again if its files have changed.
+        Return whether a new config is now in use.
+        """
+        mtimes = await asyncio.to_thread(self._read_mtimes)
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+
+        try:
+            config = await asyncio.to_thread(self._parse)
+        except Exception as e:
+            logger.error(
+                f"invalid config, keeping the current one: {type(e)}: {e}"
+            )
+            _metrics.errors.inc(stage="config")
+            return False
+
+        old = _botconf.bot_config
+        new = _botconf.use_config(config)
+        logger.info(f"loaded config version {new.version}")
+
+        for listener in self.listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                logger.error(f"{type(e)}: {e}")
+        return True
+
+    def _read_mtimes(self) -> Mtimes:
+        return (
+            _mtime(_globalconf.CONFIG_FILE),
+            _mtime(_globalconf.DEFAULT_CONFIG_FILE),
+        )
+
+    def _parse(self) -> _botconf.BotConfig:
+        with open(_globalconf.CONFIG_FILE, "r") as f:
+            return _botconf.parse_config(f)
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(_globalconf.CONFIG_POLL_INTERVAL)
+            await self.check()
+
+
+config_watcher = ConfigWatcher()
@@ -0,0 +1,155 @@
+"""
+Assembly of the context sent to the LLM
+"""
+
+from typing import Any, Protocol, Sequence
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+_CHARS_PER_TOKEN = 4
+"""Rough number of characters per token for English text"""
+_MESSAGE_TOKENS = 4
+"""Tokens taken by the chat template around each message"""
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+RETRIEVED_PREFIX = (
+    "Resources and earlier messages that may be relevant:\n"
+)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encode `obj` as compact UTF-8 JSON, with orjson if it is installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # e.g. lone surrogates, which only escaping can encode
+            pass
+    text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    try:
+        return text.encode()
+    except UnicodeEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+class _Entry(Protocol):
+    role: str
+    content: str
+    tokens: int
+    encoded: bytes
+    """The entry as a JSON message"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheaply estimate the number of tokens a message with the content
+    `text` takes in the prompt
+    """
+    return math.ceil(len(text) / _CHARS_PER_TOKEN) + _MESSAGE_TOKENS
+
+
+_encoded_system: tuple[str, bytes] = ("", b"")
+
+
+def _encode_system(content: str) -> bytes:
+    """
+    Encode a system message, reusing the last one encoded, as the system
+    prompt rarely changes
+    """
+    global _encoded_system
+
+    if _encoded_system[0] != content:
+        _encoded_system = (
+            content,
+            dumps({"role": "system", "content": content}),
+        )
+    return _encoded_system[1]
+
+
+class Prompt:
+    """
+    The messages to send to the LLM: system messages, then entries of
+    the history
+    """
+    system: list[str]
+    """Contents of the system messages"""
+    entries: list[_Entry]
+    """Oldest first"""
+    tokens: int
+    """Estimated number of tokens the messages take"""
+
+    def __init__(
+        self,
+        system: list[str],
+        entries: list[_Entry],
+        tokens: int,
+    ) -> None:
+        self.system = system
+        self.entries = entries
+        self.tokens = tokens
+
+    def messages(self) -> list[dict[str, str]]:
+        return [
+            {"role": "system", "content": content} for content in self.system
+        ] + [
+            {"role": e.role, "content": e.content} for e in self.entries
+        ]
+
+    def encode(self, fields: dict[str, Any]) -> bytes:
+        """
+        Encode a chat request made of `fields` and the messages as a
+        JSON object, reusing the encoded entries instead of encoding the
+        whole history again
+        """
+        messages = b",".join([
+            *(_encode_system(content) for content in self.system),
+            *(e.encoded for e in self.entries),
+        ])
+        head = dumps(fields)
+        if head == b"{}":
+            return b'{"messages":[' + messages + b"]}"
+        return head[:-1] + b',"messages":[' + messages + b"]}"
+
+
+def build_prompt(
+    system_prompt: str,
+    entries: Sequence[_Entry],
+    token_budget: int,
+    summary: str | None = None,
+    retrieved: Sequence[str] = (),
+) -> Prompt:
+    """
+    Build the prompt to send to the LLM, made of the system prompt, the
+    `summary` of the older conversation (if any), the `retrieved`
+    resources and messages (if any), then the newest `entries` that fit
+    in `token_budget` along with them.
+    The newest entry is always included, even if it doesn't fit.
+    A `token_budget` of 0 or less means there is no limit.
+    """
+    system = [system_prompt]
+    if summary is not None:
+        system.append(SUMMARY_PREFIX + summary)
+    if len(retrieved) > 0:
+        system.append(RETRIEVED_PREFIX + "\n".join(
+            "- " + text for text in retrieved
+        ))
+    total = sum(estimate_tokens(content) for content in system)
+
+    selected: list[_Entry] = []
+    # Go from newest to oldest, until the budget runs out
+    for entry in reversed(entries):
+        if (token_budget > 0 and len(selected) > 0
+                and total + entry.tokens > token_budget):
+            break
+        selected.append(entry)
+        total += entry.tokens
+
+    selected.reverse()
+    return Prompt(system, selected, total)
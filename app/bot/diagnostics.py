@@ -0,0 +1,255 @@
+"""
+Diagnostics of event loop stalls and slowdowns
+"""
+
+from collections import Counter, deque
+from types import FrameType
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from . import botconf as _botconf
+from . import metrics as _metrics
+
+logger = logging.getLogger(__name__)
+
+loop_lag = _metrics.registry.histogram(
+    "piclub_event_loop_lag_seconds",
+    "How late the event loop runs scheduled callbacks",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+loop_stalls = _metrics.registry.counter(
+    "piclub_event_loop_stalls_total",
+    "Number of times the event loop was blocked for too long",
+)
+
+
+class Stall:
+    """
+    A period during which the event loop was blocked
+    """
+    started_at: float
+    """`time.time()` of when the stall was detected"""
+    duration: float
+    """How long the loop was blocked, in seconds"""
+    stack: str
+    """What the loop was running when the stall was detected"""
+
+    def __init__(self, started_at: float, duration: float, stack: str):
+        self.started_at = started_at
+        self.duration = duration
+        self.stack = stack
+
+    def __str__(self) -> str:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self.started_at))
+        return (
+            f"{when} UTC, blocked for at least {self.duration:.3f}s:\n" +
+            self.stack
+        )
+
+
+class LoopLagMonitor:
+    """
+    Measures the lag of the event loop, and records stalls.
+
+    A task on the loop beats every `INTERVAL` seconds. A watchdog thread
+    checks the beats, and if the loop hasn't beaten for more than
+    `loop_stall_threshold` seconds, it records the stack of the loop's
+    thread, which is whatever is blocking it.
+    """
+    INTERVAL: float = 0.1
+
+    stalls: deque[Stall]
+    """The most recent stalls"""
+
+    def __init__(self) -> None:
+        self.stalls = deque(maxlen=20)
+        self._beat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task[None] | None = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """
+        Start monitoring the running event loop.
+        Does nothing if it is already being monitored.
+        """
+        if self._task is not None and not self._task.done():
+            return
+
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        # A new event, so a watchdog that hasn't noticed the last stop
+        # yet still stops
+        self._stop = threading.Event()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(
+            target=self._watchdog,
+            args=(self._stop,),
+            name="loop-watchdog",
+            daemon=True,
+        ).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.INTERVAL)
+            self._beat = time.monotonic()
+            loop_lag.observe(max(0.0, self._beat - before - self.INTERVAL))
+
+    def _watchdog(self, stop: threading.Event) -> None:
+        stall: Stall | None = None
+        stall_beat = 0.0
+        while not stop.wait(self.INTERVAL):
+            beat = self._beat
+            blocked = time.monotonic() - beat
+
+            if stall is not None:
+                if beat == stall_beat:
+                    # Still blocked
+                    stall.duration = blocked
+                    continue
+                logger.warning(
+                    f"event loop was blocked for {stall.duration:.3f}s"
+                )
+                stall = None
+
+            threshold = _botconf.bot_config.loop_stall_threshold
+            if threshold <= 0 or blocked < threshold:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread or 0)
+            stack = (
+                "".join(traceback.format_stack(frame))
+                if frame is not None else "(unknown)\n"
+            )
+            stall = Stall(time.time(), blocked, stack)
+            stall_beat = beat
+            self.stalls.append(stall)
+            loop_stalls.inc()
+            logger.warning(
+                f"event loop has been blocked for {blocked:.3f}s in:\n{stack}"
+            )
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+class Profiler:
+    """
+    A sampling profiler of the event loop's thread, combined with
+    tracemalloc allocation tracking, that runs for a limited time
+    """
+
+    def __init__(self) -> None:
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def run(self, seconds: float, interval: float = 0.005) -> str:
+        """
+        Profile the event loop for `seconds` seconds, sampling its stack
+        every `interval` seconds, and return a report
+        """
+        async with self._lock:
+            loop_thread = threading.get_ident()
+            samples: Counter[str] = Counter()
+            """Samples in which a function was running"""
+            cumulative: Counter[str] = Counter()
+            """Samples in which a function was on the stack"""
+            total = 0
+            stop = threading.Event()
+
+            def sample() -> None:
+                nonlocal total
+                while not stop.wait(interval):
+                    frame = sys._current_frames().get(loop_thread)
+                    if frame is None:
+                        continue
+                    total += 1
+                    samples[_frame_name(frame)] += 1
+                    seen = set()
+                    while frame is not None:
+                        name = _frame_name(frame)
+                        if name not in seen:
+                            seen.add(name)
+                            cumulative[name] += 1
+                        frame = frame.f_back
+
+            was_tracing = tracemalloc.is_tracing()
+            if not was_tracing:
+                tracemalloc.start()
+            # Snapshots of many allocations take a while, so they are
+            # taken off the event loop
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+
+            sampler = threading.Thread(
+                target=sample,
+                name="profiler",
+                daemon=True,
+            )
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                sampler.join()
+
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            if not was_tracing:
+                tracemalloc.stop()
+
+            return await asyncio.to_thread(
+                _report, seconds, total, samples, cumulative, before, after,
+            )
+
+
+def _report(
+    seconds: float,
+    total: int,
+    samples: Counter[str],
+    cumulative: Counter[str],
+    before: tracemalloc.Snapshot,
+    after: tracemalloc.Snapshot,
+) -> str:
+    lines = [f"Profiled the event loop for {seconds}s ({total} samples)", ""]
+
+    def section(title: str, counts: Counter[str]) -> None:
+        lines.append(title)
+        for name, count in counts.most_common(25):
+            lines.append(f"{100 * count / max(total, 1):6.1f}%  {name}")
+        lines.append("")
+
+    section("Running (self):", samples)
+    section("On the stack (cumulative):", cumulative)
+
+    lines.append("Allocations (net change by line):")
+    for stat in after.compare_to(before, "lineno")[:25]:
+        lines.append(str(stat))
+    lines.append("")
+
+    lines.append("Recent event loop stalls:")
+    if len(loop_lag_monitor.stalls) == 0:
+        lines.append("(none)")
+    for stall in loop_lag_monitor.stalls:
+        lines.append(str(stall))
+
+    return "\n".join(lines) + "\n"
+
+
+loop_lag_monitor = LoopLagMonitor()
+profiler = Profiler()
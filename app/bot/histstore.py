@@ -0,0 +1,304 @@
+"""
+Persistence of message history to SQLite
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import asyncio
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER,
+    author_id INTEGER,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, id);
+CREATE INDEX IF NOT EXISTS messages_message ON messages (message_id);
+CREATE TABLE IF NOT EXISTS summaries (
+    channel_id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    upto REAL NOT NULL
+);
+"""
+
+Row = tuple[int, int | None, int | None, str, str, float]
+"""(channel_id, message_id, author_id, role, content, created_at)"""
+
+
+class HistoryStore:
+    """
+    Stores message history in an SQLite database.
+
+    Writes are buffered in memory, and written in a single transaction
+    every `FLUSH_INTERVAL` seconds, or as soon as `FLUSH_SIZE` rows are
+    waiting. Only the last `KEEP_ROWS` messages of each channel are
+    kept. If the database is locked, e.g. by another worker process,
+    the rows stay queued and are written by the next flush.
+    All database access happens on a dedicated thread, so the event
+    loop never waits on SQLite.
+    """
+    FLUSH_INTERVAL: float = 2.0
+    FLUSH_SIZE: int = 50
+    KEEP_ROWS: int = 1000
+    """Messages kept per channel, older ones are deleted on writes"""
+
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._pending: list[Row] = []
+        # A single thread, so the connection is only ever used by it,
+        # and operations run in the order they were submitted
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="histstore",
+        )
+        self._flush_task: asyncio.Task[None] | None = None
+        self._size_flush: asyncio.Task[None] | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def open(self) -> None:
+        if self._conn is not None:
+            return
+
+        self._conn = await self._run(self._connect)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"opened history database {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Worker processes share the database, so wait for their
+        # transactions rather than failing right away
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            timeout=10.0,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    async def close(self) -> None:
+        if self._conn is None:
+            return
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        await self.flush()
+        conn = self._conn
+        self._conn = None
+        await self._run(conn.close)
+        self._executor.shutdown(wait=False)
+        logger.info("closed history database")
+
+    def append(
+        self,
+        channel_id: int,
+        message_id: int | None,
+        author_id: int | None,
+        role: str,
+        content: str,
+        created_at: float,
+    ) -> None:
+        """
+        Queue a message to be written to the database
+        """
+        self._pending.append(
+            (channel_id, message_id, author_id, role, content, created_at)
+        )
+
+        if (len(self._pending) >= self.FLUSH_SIZE
+                and self._conn is not None
+                and (self._size_flush is None or self._size_flush.done())):
+            self._size_flush = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        """
+        Write all queued messages to the database
+        """
+        try:
+            await self._write_pending()
+        except sqlite3.Error as e:
+            logger.error(f"{type(e)}: {e}")
+
+    async def _write_pending(self) -> None:
+        """
+        Write the queued messages.
+        If the database can't be written to right now, they are queued
+        again in front of newer messages, to be retried later.
+        """
+        if self._conn is None or len(self._pending) == 0:
+            return
+
+        rows, self._pending = self._pending, []
+        try:
+            await self._run(self._write, rows)
+        except sqlite3.OperationalError:
+            self._pending[:0] = rows
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            await self.flush()
+
+    def _write(self, rows: list[Row]) -> None:
+        if self._conn is None or len(rows) == 0:
+            return
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO messages (channel_id, message_id, author_id," +
+                " role, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            # Delete the messages of the written channels that are
+            # older than the last `KEEP_ROWS`
+            self._conn.executemany(
+                "DELETE FROM messages WHERE channel_id = ? AND id <= (" +
+                "SELECT id FROM messages WHERE channel_id = ?" +
+                " ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                [
+                    (chan_id, chan_id, self.KEEP_ROWS)
+                    for chan_id in {row[0] for row in rows}
+                ],
+            )
+
+    async def delete(self, channel_id: int, message_id: int) -> None:
+        """
+        Delete a message from the database
+        """
+        await self._execute(
+            "DELETE FROM messages WHERE channel_id = ? AND message_id = ?",
+            (channel_id, message_id),
+        )
+
+    async def update(
+        self,
+        channel_id: int,
+        message_id: int,
+        content: str,
+    ) -> None:
+        """
+        Change the content of a message in the database
+        """
+        await self._execute(
+            "UPDATE messages SET content = ?" +
+            " WHERE channel_id = ? AND message_id = ?",
+            (content, channel_id, message_id),
+        )
+
+    async def _execute(self, sql: str, params: tuple[Any, ...]) -> None:
+        if self._conn is None:
+            return
+
+        # Queued messages are written first, so the statement sees them
+        try:
+            await self._write_pending()
+            await self._run(self._execute_now, sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"{type(e)}: {e}")
+
+    def _execute_now(self, sql: str, params: tuple[Any, ...]) -> None:
+        if self._conn is None:
+            return
+
+        with self._conn:
+            self._conn.execute(sql, params)
+
+    async def save_summary(
+        self,
+        channel_id: int,
+        content: str,
+        upto: float,
+    ) -> None:
+        """
+        Save the summary of a channel, replacing the previous one
+        """
+        await self._execute(
+            "INSERT OR REPLACE INTO summaries (channel_id, content, upto)" +
+            " VALUES (?, ?, ?)",
+            (channel_id, content, upto),
+        )
+
+    async def load_summary(self, channel_id: int) -> tuple[str, float] | None:
+        """
+        Return the summary of a channel as (content, upto), or None if it
+        has none
+        """
+        if self._conn is None:
+            return None
+
+        return await self._run(self._read_summary, channel_id)
+
+    def _read_summary(self, channel_id: int) -> tuple[str, float] | None:
+        if self._conn is None:
+            return None
+
+        return self._conn.execute(
+            "SELECT content, upto FROM summaries WHERE channel_id = ?",
+            (channel_id,),
+        ).fetchone()
+
+    async def load_archive(self, limit: int) -> list[Row]:
+        """
+        Return the last `limit` messages of every channel together,
+        oldest first, including messages that haven't been flushed yet
+        """
+        if self._conn is None:
+            return []
+
+        await self._write_pending()
+        return await self._run(self._read_archive, limit)
+
+    def _read_archive(self, limit: int) -> list[Row]:
+        if self._conn is None:
+            return []
+
+        cur = self._conn.execute(
+            "SELECT channel_id, message_id, author_id, role, content," +
+            " created_at FROM messages ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )
+        return list(reversed(cur.fetchall()))
+
+    async def load(self, channel_id: int, limit: int) -> list[Row]:
+        """
+        Return the last `limit` messages of a channel, oldest first,
+        including messages that haven't been flushed yet
+        """
+        if self._conn is None:
+            return []
+
+        await self._write_pending()
+        return await self._run(self._read, channel_id, limit)
+
+    def _read(self, channel_id: int, limit: int) -> list[Row]:
+        if self._conn is None:
+            return []
+
+        cur = self._conn.execute(
+            "SELECT channel_id, message_id, author_id, role, content," +
+            " created_at FROM messages WHERE channel_id = ?" +
+            " ORDER BY id DESC LIMIT ?",
+            (channel_id, limit),
+        )
+        return list(reversed(cur.fetchall()))
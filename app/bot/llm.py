@@ -2,65 +2,474 @@
 Integration with LLMs
 """
 
+from typing import Any, AsyncIterator, Sequence
+import asyncio
 import json
 import aiohttp
 import logging
+import time
 
 import globalconf as _globalconf
+import logsetup as _logsetup
+from . import backends as _backends
 from . import botconf as _botconf
 from . import bothist as _bothist
+from . import context as _context
+from . import metrics as _metrics
+from . import modelpull as _modelpull
+from . import retrieval as _retrieval
 
 import discord
 
 logger = logging.getLogger(__name__)
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class LLMClient:
+    """
+    A long-lived HTTP client for the LLM server.
+    The underlying session keeps a pool of keep-alive connections, so
+    each request doesn't pay for a new TCP connection.
+
+    Call `start` once the event loop is running (e.g. in `on_ready`)
+    and `close` on shutdown, or use it as an async context manager.
+    """
+    _session: aiohttp.ClientSession | None
+
+    def __init__(self) -> None:
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("LLM client has not been started")
+        return self._session
+
+    async def start(self) -> None:
+        """
+        Create the pooled session. Does nothing if it is already open,
+        so it is safe to call on every (re)connect.
+        """
+        if self._session is not None and not self._session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=_globalconf.LLM_MAX_CONNECTIONS,
+            keepalive_timeout=_globalconf.LLM_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=_globalconf.LLM_CONNECT_TIMEOUT,
+            sock_read=_globalconf.LLM_READ_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+        )
+        logger.info("LLM client started")
+
+    async def close(self) -> None:
+        if self._session is None:
+            return
+
+        await self._session.close()
+        self._session = None
+        logger.info("LLM client closed")
+
+    async def __aenter__(self) -> "LLMClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+def _build_prompt(
+    message: discord.Message,
+    system_prompt: str,
+    token_budget: int,
+    use_summary: bool = False,
+    retrieved: Sequence[str] = (),
+) -> _context.Prompt:
+    """
+    Build the chat messages to send to the LLM from the system
+    prompt and the newest messages in the history of the message's
+    channel that fit in the `context_token_budget`.
+    If `use_summary` is True and the channel has a summary, it replaces
+    the messages it includes. The `retrieved` resources and messages are
+    added after it.
+    """
+    logger.info(
+        "Generating response ...\nSystem prompt:\n%s\nUser prompt:\n%s",
+        system_prompt,
+        message.content,
+        extra={"channel": message.channel.id, "message_id": message.id},
+    )
+
+    entries: Sequence[_bothist.HistoryEntry] = (
+        _bothist.bot_history.entries(message.channel.id)
+    )
+    summary = None
+    if use_summary:
+        summary = _bothist.bot_history.summary(message.channel.id)
+    if summary is not None:
+        upto = summary.upto
+        entries = [e for e in entries if e.timestamp > upto]
+
+    prompt = _context.build_prompt(
+        system_prompt,
+        entries,
+        token_budget,
+        summary.content if summary is not None else None,
+        retrieved,
+    )
+
+    logger.info(
+        "%s",
+        _logsetup.lazy(_preview, prompt),
+        extra={"estimated_tokens": prompt.tokens},
+    )
+
+    return prompt
+
+
+def _preview(prompt: _context.Prompt) -> str:
+    return ", ".join([
+        f"{{{m['role'][0:1]}: '{m['content'][0:10]}'}}"
+        for m in prompt.messages()
+    ])
+
+
+def _record_durations(
+    data: dict[str, Any],
+    model: str,
+    estimated_tokens: int,
+) -> None:
+    """
+    Log the timings Ollama returns with a response, and add them to the
+    metrics
+    """
+    dur = data["total_duration"] / 1_000_000_000
+    load = data.get("load_duration", 0) / 1_000_000_000
+    prompt = data.get("prompt_eval_duration", 0) / 1_000_000_000
+    gen = data.get("eval_duration", 0) / 1_000_000_000
+    logger.info(
+        "response took %.3f seconds (loading model: %.3f, prompt: %.3f, " +
+        "generation: %.3f)",
+        dur,
+        load,
+        prompt,
+        gen,
+        extra={"model": model},
+    )
+
+    _metrics.llm_requests.inc(model=model, outcome="ok")
+    _metrics.llm_duration.observe(dur, model=model, phase="total")
+    _metrics.llm_duration.observe(load, model=model, phase="load")
+    _metrics.llm_duration.observe(prompt, model=model, phase="prompt")
+    _metrics.llm_duration.observe(gen, model=model, phase="generation")
+    if gen > 0 and "eval_count" in data:
+        _metrics.llm_tokens_per_second.observe(
+            data["eval_count"] / gen,
+            model=model,
+        )
+
+    if "prompt_eval_count" in data:
+        logger.info(
+            "prompt took %d tokens (estimated %d)",
+            data["prompt_eval_count"],
+            estimated_tokens,
+            extra={"model": model},
+        )
+        _metrics.llm_prompt_tokens.observe(
+            data["prompt_eval_count"],
+            model=model,
+        )
+
+
+def _record_error(model: str) -> None:
+    _metrics.llm_requests.inc(model=model, outcome="error")
+    _metrics.errors.inc(stage="llm")
+
+
+def _abort(res: aiohttp.ClientResponse, model: str) -> None:
+    """
+    Close the connection of a response that is no longer wanted, so the
+    server stops generating it
+    """
+    res.close()
+    _metrics.llm_requests.inc(model=model, outcome="cancelled")
+    logger.info("response cancelled")
+
+
+def _handle_error(
+    data: dict[str, Any],
+    backend: _backends.Backend,
+    model: str,
+    auto_pull_model: bool,
+) -> None:
+    logger.error(f"{data['error']}")
+    logger.info("data: %s", _logsetup.lazy(json.dumps, data))
+    _record_error(model)
+
+    if "not found" in str(data["error"]):
+        # Don't route requests for this model here until it is pulled
+        backend.models.discard(_backends.normalize_model(model))
+        if auto_pull_model:
+            _modelpull.model_puller.pull(backend, model)
+
 
 async def generate_response(
     message: discord.Message,
-    system_prompt: str = _botconf.bot_config.system_prompt,
-    # TODO: Use this again
-    auto_pull_model: bool = _botconf.bot_config.auto_pull_model
+    system_prompt: str | None = None,
+    auto_pull_model: bool | None = None,
+    config: _botconf.BotConfig | None = None,
+    model: str | None = None,
 ) -> str | None:
-    url = f"http://{_globalconf.LLM_HOST}:{_globalconf.LLM_PORT}/api/chat"
-    logger.info(f"url: {url}")
+    """
+    Generate a response to `message` with `model`, using the history of
+    its channel.
+    If the model isn't available on the server and `auto_pull_model` is
+    True, start pulling it in the background.
+    `system_prompt`, `auto_pull_model` and `model` default to the values
+    in `config` (`llm_model` for the model), which defaults to the
+    current config.
+    Return None if the response couldn't be generated.
+    """
+    if config is None:
+        config = _botconf.bot_config
+    if system_prompt is None:
+        system_prompt = config.system_prompt
+    if auto_pull_model is None:
+        auto_pull_model = config.auto_pull_model
+    if model is None:
+        model = config.llm_model
 
     # While receiving responses, show typing status
     async with message.channel.typing():
-        logger.info(
-            "Generating response ...\n" +
-            f"System prompt:\n{system_prompt}\n" +
-            f"User prompt:\n{message.content}"
+        retrieved = await _retrieval.retriever.retrieve(message, config)
+        prompt = _build_prompt(
+            message,
+            system_prompt,
+            config.context_token_budget,
+            config.summarize_history,
+            retrieved,
         )
 
-        messages: list[dict[str, str]] = [
-            {"role": "system", "content": system_prompt},
-            *_bothist.bot_history.message_histories[message.channel.id],
-        ]
+        try:
+            async with _backends.backend_pool.acquire(model) as backend:
+                url = f"{backend.url}/api/chat"
+                logger.info("url: %s", url)
 
-        logger.info(", ".join([
-            f"{{{m['role'][0:1]}: '{m['content'][0:10]}'}}"
-            for m in messages
-        ]))
+                async with llm_client.session.post(
+                    url,
+                    data=prompt.encode({
+                        "model": model,
+                        "stream": False,
+                        "keep_alive": config.llm_keep_alive,
+                    }),
+                    headers=_JSON_HEADERS,
+                ) as res:
+                    try:
+                        data = await res.json()
+                    except asyncio.CancelledError:
+                        _abort(res, model)
+                        raise
 
-        async with aiohttp.ClientSession() as cs:
-            try:
-                async with cs.post(url, json={
-                    "model": _botconf.bot_config.llm_model,
-                    "stream": False,
-                    "messages": messages,
-                }) as res:
-                    data = await res.json()
                     if "error" in data:
-                        logger.error(f"{data['error']}")
-                        logger.info(f"data: {json.dumps(data)}")
+                        _handle_error(data, backend, model, auto_pull_model)
                         return None
 
-                    dur = data["total_duration"] / 1_000_000_000
-                    logger.info(f"response took {dur:.3f} seconds")
+                    _record_durations(data, model, prompt.tokens)
 
                     return data["message"]["content"]
 
-            except Exception as e:
-                logger.error(f"{type(e)}: {e}")
+        except Exception as e:
+            logger.error(f"{type(e)}: {e}")
+            _record_error(model)
+
+            return None
+
+
+class StreamStatus:
+    """
+    How a streamed response ended
+    """
+    complete: bool
+    """
+    Whether the LLM finished the response, as opposed to the stream
+    ending early because of an error
+    """
+
+    def __init__(self) -> None:
+        self.complete = False
+
+
+async def stream_response(
+    message: discord.Message,
+    system_prompt: str | None = None,
+    auto_pull_model: bool | None = None,
+    config: _botconf.BotConfig | None = None,
+    model: str | None = None,
+    status: StreamStatus | None = None,
+) -> AsyncIterator[str]:
+    """
+    Like `generate_response`, but yield the response in chunks as the
+    LLM generates them, instead of waiting for the whole response.
+    Errors are logged, and end the stream early. Whether the response
+    was finished is recorded in `status`, if given.
+    """
+    if config is None:
+        config = _botconf.bot_config
+    if system_prompt is None:
+        system_prompt = config.system_prompt
+    if auto_pull_model is None:
+        auto_pull_model = config.auto_pull_model
+    if model is None:
+        model = config.llm_model
+
+    async with message.channel.typing():
+        retrieved = await _retrieval.retriever.retrieve(message, config)
+        prompt = _build_prompt(
+            message,
+            system_prompt,
+            config.context_token_budget,
+            config.summarize_history,
+            retrieved,
+        )
+
+        try:
+            async with _backends.backend_pool.acquire(model) as backend:
+                url = f"{backend.url}/api/chat"
+                logger.info("url: %s", url)
+
+                started = time.monotonic()
+                first_token = True
+                async with llm_client.session.post(
+                    url,
+                    data=prompt.encode({
+                        "model": model,
+                        "stream": True,
+                        "keep_alive": config.llm_keep_alive,
+                    }),
+                    headers=_JSON_HEADERS,
+                ) as res:
+                    try:
+                        # The response is newline delimited JSON,
+                        # with one object per chunk
+                        async for line in res.content:
+                            if line.strip() == b"":
+                                continue
+
+                            data = json.loads(line)
+                            if "error" in data:
+                                _handle_error(
+                                    data, backend, model, auto_pull_model,
+                                )
+                                return
+
+                            chunk = data.get("message", {})
+                            content = chunk.get("content", "")
+                            if content != "":
+                                if first_token:
+                                    first_token = False
+                                    _metrics.time_to_first_token.observe(
+                                        time.monotonic() - started,
+                                        model=model,
+                                        channel=message.channel.id,
+                                    )
+                                yield content
+
+                            if data.get("done", False):
+                                if status is not None:
+                                    status.complete = True
+                                _record_durations(data, model, prompt.tokens)
+                                return
+
+                        # The server closed the stream before the end
+                        logger.error("response stream ended early")
+                        _record_error(model)
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # Cancelled, or the caller stopped reading
+                        _abort(res, model)
+                        raise
+
+        except Exception as e:
+            logger.error(f"{type(e)}: {e}")
+            _record_error(model)
+
+
+_SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation in a Discord" +
+    " channel. You are given the current summary (which may be empty)" +
+    " and the messages that came after it. Reply with an updated" +
+    " summary of the whole conversation, in at most {words} words." +
+    " Keep the names and mentions of the people involved, the questions" +
+    " that were asked and the answers and facts that were given." +
+    " Reply with the summary only."
+)
+
+
+async def generate_summary(
+    previous: str,
+    entries: Sequence[_bothist.HistoryEntry],
+    config: _botconf.BotConfig,
+) -> str | None:
+    """
+    Generate a summary of a conversation made of the `previous` summary
+    followed by `entries`, in at most `summary_max_words` words.
+    Return None if the summary couldn't be generated.
+    """
+    model = config.llm_model
+    conversation = "\n".join(
+        ("(you) " if e.role == "assistant" else "") + e.content
+        for e in entries
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": _SUMMARY_PROMPT.format(words=config.summary_max_words),
+        },
+        {
+            "role": "user",
+            "content": (
+                f"Current summary:\n{previous}\n\n" +
+                f"New messages:\n{conversation}"
+            ),
+        },
+    ]
+
+    try:
+        async with _backends.backend_pool.acquire(model) as backend:
+            async with llm_client.session.post(
+                f"{backend.url}/api/chat",
+                json={
+                    "model": model,
+                    "stream": False,
+                    "messages": messages,
+                    "keep_alive": config.llm_keep_alive,
+                },
+            ) as res:
+                try:
+                    data = await res.json()
+                except asyncio.CancelledError:
+                    _abort(res, model)
+                    raise
+
+                if "error" in data:
+                    _handle_error(
+                        data, backend, model, config.auto_pull_model,
+                    )
+                    return None
+
+                _record_durations(data, model, 0)
+                return data["message"]["content"].strip()
+
+    except Exception as e:
+        logger.error(f"{type(e)}: {e}")
+        _record_error(model)
+        return None
+
 
-                return None
+llm_client = LLMClient()
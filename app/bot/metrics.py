@@ -0,0 +1,345 @@
+"""
+In-process metrics, exported in the Prometheus text format
+"""
+
+from typing import Callable
+import bisect
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    )
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(
+        f"{n}=\"{_escape(v)}\"" for n, v in zip(names, values)
+    ) + "}"
+
+
+class _Metric:
+    TYPE: str = ""
+
+    name: str
+    help: str
+    labelnames: tuple[str, ...]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+    def _key(self, labels: dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.TYPE}",
+            *self._samples(),
+        ]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+    TYPE = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1, **labels: object) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def set_total(self, value: float, **labels: object) -> None:
+        """Set the value, for counters kept somewhere else"""
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, k)} {v}"
+            for k, v in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    """A value that can go up and down"""
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Counts observed values in buckets"""
+    TYPE = "histogram"
+
+    buckets: tuple[float, ...]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = (
+            0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+        ),
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            # One count per bucket, plus one for +Inf
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(
+                    (*self.labelnames, "le"),
+                    (*key, str(bound)),
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {self._sums[key]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    A collection of metrics.
+    Collectors are called before rendering, to update metrics whose
+    values are kept elsewhere (e.g. queue depth).
+    """
+    metrics: list[_Metric]
+    collectors: list[Callable[[], None]]
+
+    def __init__(self) -> None:
+        self.metrics = []
+        self.collectors = []
+        self._runner: web.AppRunner | None = None
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        metric = Gauge(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"{type(e)}: {e}")
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> None:
+        """
+        Serve the metrics at `http://host:port/metrics`.
+        Does nothing if they are already being served.
+        """
+        if self._runner is not None:
+            return
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(
+                text=self.render(),
+                content_type="text/plain",
+                charset="utf-8",
+                headers={"X-Prometheus-Version": "0.0.4"},
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"serving metrics on http://{host}:{port}/metrics")
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+registry = Registry()
+
+llm_requests = registry.counter(
+    "piclub_llm_requests_total",
+    "LLM requests, by model and outcome",
+    ("model", "outcome"),
+)
+llm_duration = registry.histogram(
+    "piclub_llm_duration_seconds",
+    "Time taken by the phases of LLM requests, as reported by Ollama",
+    ("model", "phase"),
+)
+llm_tokens_per_second = registry.histogram(
+    "piclub_llm_tokens_per_second",
+    "Speed at which responses are generated",
+    ("model",),
+    buckets=(1, 2.5, 5, 10, 20, 40, 80, 160),
+)
+llm_prompt_tokens = registry.histogram(
+    "piclub_llm_prompt_tokens",
+    "Number of tokens in prompts",
+    ("model",),
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192),
+)
+time_to_first_token = registry.histogram(
+    "piclub_time_to_first_token_seconds",
+    "Time from sending a request to receiving the first token",
+    ("model", "channel"),
+)
+queue_wait = registry.histogram(
+    "piclub_queue_wait_seconds",
+    "Time mentions wait in the queue before generation starts",
+    ("channel",),
+)
+discord_send = registry.histogram(
+    "piclub_discord_send_seconds",
+    "Time taken to send or edit a message on Discord",
+    ("operation",),
+)
+routes = registry.counter(
+    "piclub_routes_total",
+    "Mentions sent to each route, by route and model",
+    ("route", "model"),
+)
+route_duration = registry.histogram(
+    "piclub_route_duration_seconds",
+    "Time taken to answer a mention, from the start of its generation" +
+    " to its last reply, by route",
+    ("route",),
+)
+mentions = registry.counter(
+    "piclub_mentions_total",
+    "Mentions of the bot, by what happened to them",
+    ("channel", "outcome"),
+)
+admission = registry.counter(
+    "piclub_admission_total",
+    "Mentions checked by admission control, by outcome " +
+    "(admitted, or the limit that refused them)",
+    ("outcome",),
+)
+expected_wait = registry.gauge(
+    "piclub_expected_wait_seconds",
+    "Estimated time a new mention would wait for a generation slot",
+)
+generation_run_time = registry.gauge(
+    "piclub_generation_run_time_seconds",
+    "Moving average of the time a generation holds its slot",
+)
+summaries = registry.counter(
+    "piclub_summaries_total",
+    "Attempts to summarize the history of a channel, by outcome",
+    ("outcome",),
+)
+retrievals = registry.counter(
+    "piclub_retrievals_total",
+    "Retrievals of context for mentions, by outcome",
+    ("outcome",),
+)
+retrieval_duration = registry.histogram(
+    "piclub_retrieval_duration_seconds",
+    "Time taken to retrieve the context of a mention",
+)
+retrieval_documents = registry.gauge(
+    "piclub_retrieval_documents",
+    "Number of documents that can be retrieved, by index",
+    ("index",),
+)
+commands = registry.counter(
+    "piclub_commands_total",
+    "Commands, by what happened to them",
+    ("command", "outcome"),
+)
+errors = registry.counter(
+    "piclub_errors_total",
+    "Errors, by where they happened",
+    ("stage",),
+)
+history_channels = registry.gauge(
+    "piclub_history_channels",
+    "Number of channels with a history in memory",
+)
+history_entries = registry.gauge(
+    "piclub_history_entries",
+    "Number of messages in the history in memory",
+)
+history_backfill = registry.histogram(
+    "piclub_history_backfill_seconds",
+    "Time taken to fetch the history of a channel from Discord",
+)
+history_bytes = registry.gauge(
+    "piclub_history_bytes",
+    "Approximate memory used by the history",
+)
+queue_depth = registry.gauge(
+    "piclub_queue_depth",
+    "Number of mentions waiting for a generation slot",
+)
+in_flight = registry.gauge(
+    "piclub_generations_in_flight",
+    "Number of generations running",
+)
+backend_outstanding = registry.gauge(
+    "piclub_backend_outstanding_requests",
+    "Number of requests being handled by each LLM server",
+    ("backend",),
+)
+backend_available = registry.gauge(
+    "piclub_backend_available",
+    "Whether each LLM server is receiving requests",
+    ("backend",),
+)
+response_cache = registry.counter(
+    "piclub_response_cache_lookups_total",
+    "Response cache lookups, by result",
+    ("result",),
+)
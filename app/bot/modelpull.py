@@ -0,0 +1,197 @@
+"""
+Pulling of LLM models onto the Ollama servers in the background
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from . import backends as _backends
+
+logger = logging.getLogger(__name__)
+
+
+class PullProgress:
+    """
+    The progress of pulling a model onto a single server
+    """
+    backend_url: str
+    model: str
+    status: str
+    """The last status reported by the server"""
+    completed: int
+    """Bytes downloaded of the layer currently being pulled"""
+    total: int
+    """Size of the layer currently being pulled, in bytes"""
+    error: str | None
+    done: bool
+    started_at: float
+
+    def __init__(self, backend_url: str, model: str) -> None:
+        self.backend_url = backend_url
+        self.model = model
+        self.status = "starting"
+        self.completed = 0
+        self.total = 0
+        self.error = None
+        self.done = False
+        self.started_at = time.monotonic()
+
+    @property
+    def percent(self) -> float | None:
+        if self.total <= 0:
+            return None
+        return 100 * self.completed / self.total
+
+    def __str__(self) -> str:
+        s = f"`{self.model}` on {self.backend_url}: "
+        if self.error is not None:
+            return s + f"failed ({self.error})"
+        s += self.status
+        if self.percent is not None and not self.done:
+            s += f" ({self.percent:.1f}%)"
+        return s
+
+
+class ModelPuller:
+    """
+    Pulls models onto the servers that don't have them, streaming the
+    progress of each pull without blocking the event loop
+    """
+    progress: dict[tuple[str, str], PullProgress]
+    """The progress of the latest pull of each (server URL, model)"""
+
+    def __init__(self) -> None:
+        self.progress = {}
+        self._session: aiohttp.ClientSession | None = None
+        self._tasks: dict[tuple[str, str], asyncio.Task[None]] = {}
+
+    def start(self, session: aiohttp.ClientSession) -> None:
+        """
+        Use `session` for pulling models from now on
+        """
+        self._session = session
+
+    async def stop(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    def is_pulling(self, model: str) -> bool:
+        model = _backends.normalize_model(model)
+        return any(
+            m == model and not task.done()
+            for (_, m), task in self._tasks.items()
+        )
+
+    def ensure(self, model: str) -> bool:
+        """
+        Start pulling `model` onto every available server that doesn't
+        have it.
+        Return whether a pull is in progress.
+        """
+        normalized = _backends.normalize_model(model)
+        for backend in _backends.backend_pool.backends:
+            if backend.available and normalized not in backend.models:
+                self.pull(backend, model)
+        return self.is_pulling(model)
+
+    def pull(self, backend: _backends.Backend, model: str) -> None:
+        """
+        Start pulling `model` onto `backend` in the background,
+        unless it is already being pulled there
+        """
+        key = (backend.url, _backends.normalize_model(model))
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return
+
+        self.progress[key] = PullProgress(backend.url, model)
+        self._tasks[key] = asyncio.create_task(
+            self._pull(backend, model, self.progress[key])
+        )
+
+    async def wait(self, model: str) -> None:
+        """
+        Wait until every pull of `model` has finished
+        """
+        model = _backends.normalize_model(model)
+        tasks = [
+            task for (_, m), task in self._tasks.items()
+            if m == model and not task.done()
+        ]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+    def summary(self) -> str:
+        """
+        Describe the progress of every pull
+        """
+        if len(self.progress) == 0:
+            return "No models have been pulled"
+        return "\n".join(
+            "- " + str(p) for p in self.progress.values()
+        )
+
+    async def _pull(
+        self,
+        backend: _backends.Backend,
+        model: str,
+        progress: PullProgress,
+    ) -> None:
+        if self._session is None:
+            progress.error = "not started"
+            return
+
+        key = (backend.url, _backends.normalize_model(model))
+        logger.info(f"pulling {model} onto {backend.url}")
+        try:
+            async with self._session.post(f"{backend.url}/api/pull", json={
+                "model": model,
+                # Older versions of Ollama use `name` instead of `model`
+                "name": model,
+                "stream": True,
+            }) as res:
+                async for line in res.content:
+                    if line.strip() == b"":
+                        continue
+
+                    data = json.loads(line)
+                    if "error" in data:
+                        progress.error = data["error"]
+                        logger.error(
+                            f"failed to pull {model} onto {backend.url}: " +
+                            f"{data['error']}"
+                        )
+                        return
+
+                    progress.status = data.get("status", progress.status)
+                    progress.completed = data.get("completed", 0)
+                    progress.total = data.get("total", 0)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # ValueError: a malformed progress line
+            progress.error = f"{type(e).__name__}: {e}"
+            logger.error(
+                f"failed to pull {model} onto {backend.url}: " +
+                f"{type(e)}: {e}"
+            )
+            return
+        finally:
+            progress.done = True
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+        if progress.status == "success":
+            backend.models.add(_backends.normalize_model(model))
+            dur = time.monotonic() - progress.started_at
+            logger.info(
+                f"pulled {model} onto {backend.url} in {dur:.1f} seconds"
+            )
+        else:
+            progress.error = "pull ended early"
+
+
+model_puller = ModelPuller()
@@ -0,0 +1,142 @@
+"""
+Caching of LLM responses to repeated questions
+"""
+
+from collections import OrderedDict
+from typing import Any, Iterable
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+
+from . import botconf as _botconf
+from . import sharedstore as _sharedstore
+
+logger = logging.getLogger(__name__)
+
+_MENTION_RE = re.compile(r"<@[!&]?\d+>")
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """
+    Normalize a message, so that trivially different ways of asking the
+    same thing (case, punctuation, spacing, mentions) compare equal
+    """
+    text = _MENTION_RE.sub(" ", text.lower())
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def make_key(
+    model: str,
+    system_prompt: str,
+    text: str,
+    context: Iterable[str] = (),
+) -> str:
+    """
+    Make the cache key of a response by `model` with `system_prompt`
+    to a message `text`, preceded by the messages in `context`
+    """
+    h = hashlib.sha256()
+    h.update(model.encode())
+    h.update(b"\0")
+    h.update(hashlib.sha256(system_prompt.encode()).digest())
+    for c in context:
+        h.update(b"\0")
+        h.update(normalize(c).encode())
+    h.update(b"\0")
+    h.update(normalize(text).encode())
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """
+    A size-bounded LRU cache of responses, whose entries expire after
+    `response_cache_ttl` seconds.
+    The size and TTL are read from the bot config.
+    If the bot runs in several processes, the responses are kept in the
+    shared store instead, so every shard can reuse them.
+    """
+    hits: int
+    misses: int
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        """Maps keys to (expiry time, response), oldest used first"""
+
+    async def get(self, key: str) -> str | None:
+        """
+        Return the cached response for `key`, or None if there is none
+        """
+        store = _sharedstore.shared_store
+        if store is not None and store.is_open:
+            try:
+                response = await store.cache_get(key, time.time())
+            except sqlite3.Error as e:
+                logger.error(f"{type(e)}: {e}")
+                response = None
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, response = entry
+        if time.monotonic() >= expires:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    async def put(self, key: str, response: str) -> None:
+        config = _botconf.bot_config
+        store = _sharedstore.shared_store
+        if store is not None and store.is_open:
+            try:
+                await store.cache_put(
+                    key,
+                    response,
+                    time.time(),
+                    config.response_cache_ttl,
+                    config.response_cache_size,
+                )
+            except sqlite3.Error as e:
+                logger.error(f"{type(e)}: {e}")
+            return
+
+        self._entries[key] = (
+            time.monotonic() + config.response_cache_ttl,
+            response,
+        )
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > max(0, config.response_cache_size):
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,431 @@
+"""
+Retrieval of resources and archived messages relevant to a mention,
+using embeddings from the LLM servers
+"""
+
+from collections import deque
+from typing import Any, Iterable, Sequence
+import asyncio
+import logging
+import sqlite3
+import time
+
+import aiohttp
+import discord
+
+from . import backends as _backends
+from . import botconf as _botconf
+from . import bothist as _bothist
+from . import metrics as _metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_CHANNEL = 0
+"""Channel of the documents that can be retrieved in every channel"""
+
+
+class Document:
+    """
+    A piece of text that can be retrieved
+    """
+    __slots__ = ("key", "channel_id", "text")
+
+    key: int
+    """The ID of the message, or the position of the resource"""
+    channel_id: int
+    """
+    The channel the document can be retrieved in, or `RESOURCE_CHANNEL`
+    """
+    text: str
+
+    def __init__(self, key: int, channel_id: int, text: str) -> None:
+        self.key = key
+        self.channel_id = channel_id
+        self.text = text
+
+
+class VectorIndex:
+    """
+    The unit embedding vectors of documents, as the rows of a matrix.
+    The matrix doubles in size when it is full, so adding documents
+    is cheap, and a search is a single matrix-vector product.
+    """
+
+    def __init__(self) -> None:
+        self.documents: list[Document] = []
+        self._positions: dict[int, int] = {}
+        """Row of each document, by key"""
+        self._matrix: Any = None
+        self._channels: Any = None
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._positions
+
+    def clear(self) -> None:
+        self.documents = []
+        self._positions = {}
+        self._matrix = None
+        self._channels = None
+
+    def add(self, documents: Sequence[Document], vectors: Any) -> None:
+        """
+        Add documents along with their embeddings, as the rows of
+        `vectors`.
+        Documents that are already in the index are replaced, and if
+        several documents have the same key, the last one is kept.
+        """
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        rows = {doc.key: i for i, doc in enumerate(documents)}
+        if len(rows) < len(documents):
+            documents = [documents[i] for i in rows.values()]
+            vectors = vectors[list(rows.values())]
+        for doc in documents:
+            self.remove(doc.key)
+
+        count = len(self.documents)
+        dim = vectors.shape[1]
+        if self._matrix is not None and self._matrix.shape[1] != dim:
+            # Embeddings of another model can't be compared
+            self.clear()
+            count = 0
+
+        needed = count + len(documents)
+        if self._matrix is None or needed > self._matrix.shape[0]:
+            capacity = 64
+            while capacity < needed:
+                capacity *= 2
+            matrix = np.empty((capacity, dim), dtype=np.float32)
+            channels = np.empty(capacity, dtype=np.int64)
+            if self._matrix is not None:
+                matrix[:count] = self._matrix[:count]
+                channels[:count] = self._channels[:count]
+            self._matrix = matrix
+            self._channels = channels
+
+        self._matrix[count:needed] = vectors
+        self._channels[count:needed] = [d.channel_id for d in documents]
+        for i, doc in enumerate(documents, count):
+            self._positions[doc.key] = i
+            self.documents.append(doc)
+
+    def remove(self, key: int) -> bool:
+        """
+        Remove a document by key.
+        Return whether it was in the index.
+        """
+        pos = self._positions.pop(key, None)
+        if pos is None:
+            return False
+
+        # Move the last row into the hole
+        last = len(self.documents) - 1
+        if pos != last:
+            moved = self.documents[last]
+            self.documents[pos] = moved
+            self._matrix[pos] = self._matrix[last]
+            self._channels[pos] = self._channels[last]
+            self._positions[moved.key] = pos
+        self.documents.pop()
+        return True
+
+    def search(
+        self,
+        query: Any,
+        k: int,
+        channel_id: int,
+        exclude: Iterable[int] = (),
+    ) -> list[tuple[float, Document]]:
+        """
+        Return the (up to) `k` documents most similar to the `query`
+        vector that can be retrieved in a channel, leaving out the keys
+        in `exclude`, with their cosine similarity, most similar first
+        """
+        count = len(self.documents)
+        if count == 0 or k <= 0 or query.shape[0] != self._matrix.shape[1]:
+            return []
+
+        scores = self._matrix[:count] @ _normalize(query)
+        channels = self._channels[:count]
+        allowed = (channels == channel_id) | (channels == RESOURCE_CHANNEL)
+        scores[~allowed] = -np.inf
+        excluded = [
+            self._positions[key] for key in exclude if key in self._positions
+        ]
+        scores[excluded] = -np.inf
+
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), self.documents[i])
+            for i in top if scores[i] > -np.inf
+        ]
+
+
+def _normalize(vectors: Any) -> Any:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class Retriever:
+    """
+    Indexes the resources of the config, and the messages that no
+    longer fit in the history of their channel (including the ones in
+    the history store), so the ones most relevant to a mention can be
+    added to the prompt.
+
+    Documents are embedded in batches in the background, with the
+    `embedding_model`. Archived messages can only be retrieved in their
+    own channel, and at most `retrieval_max_documents` of them are kept,
+    dropping the oldest.
+
+    Retrieval needs NumPy, and is disabled without it.
+    """
+    BATCH_SIZE: int = 32
+    """Documents embedded per request"""
+    INTERVAL: float = 2.0
+    """Seconds between indexing new documents"""
+    TIMEOUT: float = 5.0
+    """Seconds to wait for the embedding of a mention"""
+    SNIPPET_CHARS: int = 500
+    """Longest text of a document added to the prompt"""
+
+    resources: VectorIndex
+    messages: VectorIndex
+
+    def __init__(self) -> None:
+        self.resources = VectorIndex()
+        self.messages = VectorIndex()
+        self._pending: deque[Document] = deque()
+        self._order: deque[int] = deque()
+        """Keys of the indexed messages, oldest first"""
+        self._indexed: tuple[str, tuple[str, ...]] | None = None
+        """Model and resources the resource index was built with"""
+        self._model: str | None = None
+        """Model the message index was built with"""
+        self._session: aiohttp.ClientSession | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    def enabled(self, config: _botconf.BotConfig) -> bool:
+        return config.retrieve_context and np is not None
+
+    def start(self, session: aiohttp.ClientSession) -> None:
+        """
+        Start indexing documents in the background, embedding them with
+        `session`.
+        Does nothing if it has already been started.
+        """
+        self._session = session
+        if self._task is not None and not self._task.done():
+            return
+
+        if np is None and _botconf.bot_config.retrieve_context:
+            logger.warning("NumPy isn't installed, retrieval is disabled")
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def archive(self, chan_id: int, entry: _bothist.HistoryEntry) -> None:
+        """
+        Queue a history entry to be indexed
+        """
+        if entry.message_id is None:
+            return
+        if self.enabled(_botconf.bot_config):
+            self._queue(Document(entry.message_id, chan_id, entry.content))
+
+    def _queue(self, doc: Document) -> None:
+        limit = _botconf.bot_config.retrieval_max_documents
+        if len(self._pending) >= limit:
+            self._pending.popleft()
+        self._pending.append(doc)
+
+    def forget(self, message_id: int) -> None:
+        """
+        Remove a message from the index, e.g. because it was deleted
+        """
+        if self.messages.remove(message_id):
+            return
+        if any(d.key == message_id for d in self._pending):
+            self._pending = deque(
+                d for d in self._pending if d.key != message_id
+            )
+
+    async def load_archive(self) -> None:
+        """
+        Queue the newest messages of the history store to be indexed
+        """
+        config = _botconf.bot_config
+        store = _bothist.bot_history.store
+        if not self.enabled(config) or store is None:
+            return
+
+        try:
+            rows = await store.load_archive(config.retrieval_max_documents)
+        except sqlite3.Error as e:
+            logger.error(f"{type(e)}: {e}")
+            _metrics.errors.inc(stage="retrieval")
+            return
+
+        for chan_id, message_id, _, _, content, _ in rows:
+            if message_id is not None and message_id not in self.messages:
+                self._queue(Document(message_id, chan_id, content))
+        logger.info(f"queued {len(rows)} archived messages for indexing")
+
+    async def embed(
+        self,
+        texts: list[str],
+        config: _botconf.BotConfig,
+    ) -> Any:
+        """
+        Return the embeddings of `texts` as the rows of a matrix, or
+        None if they couldn't be computed
+        """
+        if self._session is None:
+            return None
+
+        model = config.embedding_model
+        try:
+            async with _backends.backend_pool.acquire(model) as backend:
+                async with self._session.post(
+                    f"{backend.url}/api/embed",
+                    json={
+                        "model": model,
+                        "input": texts,
+                        "keep_alive": config.llm_keep_alive,
+                    },
+                ) as res:
+                    data = await res.json()
+
+            if "error" in data:
+                raise ValueError(data["error"])
+            vectors = np.asarray(data["embeddings"], dtype=np.float32)
+            if vectors.shape[0] != len(texts):
+                raise ValueError(
+                    f"got {vectors.shape[0]} embeddings for " +
+                    f"{len(texts)} texts"
+                )
+            return vectors
+
+        except Exception as e:
+            logger.error(f"{type(e)}: {e}")
+            _metrics.errors.inc(stage="retrieval")
+            return None
+
+    async def retrieve(
+        self,
+        message: discord.Message,
+        config: _botconf.BotConfig,
+    ) -> list[str]:
+        """
+        Return the texts of the (up to) `retrieval_top_k` documents most
+        relevant to a message, leaving out the messages that are still
+        in the history of its channel
+        """
+        if (not self.enabled(config) or config.retrieval_top_k <= 0
+                or len(self.resources) + len(self.messages) == 0):
+            return []
+
+        started = time.monotonic()
+        try:
+            vectors = await asyncio.wait_for(
+                self.embed([message.content], config),
+                self.TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("timed out embedding a mention")
+            vectors = None
+        if vectors is None:
+            _metrics.retrievals.inc(outcome="failed")
+            return []
+
+        chan_id = message.channel.id
+        k = config.retrieval_top_k
+        in_history = (
+            e.message_id for e in _bothist.bot_history.entries(chan_id)
+            if e.message_id is not None
+        )
+        results = (
+            self.resources.search(vectors[0], k, chan_id) +
+            self.messages.search(vectors[0], k, chan_id, in_history)
+        )
+        results.sort(key=lambda r: r[0], reverse=True)
+        texts = [
+            doc.text[:self.SNIPPET_CHARS]
+            for score, doc in results[:k]
+            if score >= config.retrieval_min_score
+        ]
+
+        _metrics.retrieval_duration.observe(time.monotonic() - started)
+        _metrics.retrievals.inc(outcome="hit" if texts else "miss")
+        logger.info("retrieved %d documents", len(texts))
+        return texts
+
+    async def _loop(self) -> None:
+        while True:
+            config = _botconf.bot_config
+            if self.enabled(config):
+                await self._index_resources(config)
+                await self._index_messages(config)
+            await asyncio.sleep(self.INTERVAL)
+
+    async def _index_resources(self, config: _botconf.BotConfig) -> None:
+        resources = tuple(str(r) for r in config.resources)
+        indexed = (config.embedding_model, resources)
+        if indexed == self._indexed:
+            return
+
+        index = VectorIndex()
+        for i in range(0, len(resources), self.BATCH_SIZE):
+            batch = resources[i:i + self.BATCH_SIZE]
+            vectors = await self.embed(batch, config)
+            if vectors is None:
+                # Try again later
+                return
+            index.add([
+                Document(j, RESOURCE_CHANNEL, text)
+                for j, text in enumerate(batch, i)
+            ], vectors)
+
+        self.resources = index
+        self._indexed = indexed
+        logger.info(f"indexed {len(resources)} resources")
+
+    async def _index_messages(self, config: _botconf.BotConfig) -> None:
+        if config.embedding_model != self._model:
+            # Start over from the store, as embeddings of another model
+            # can't be compared
+            self.messages.clear()
+            self._order.clear()
+            self._model = config.embedding_model
+            await self.load_archive()
+
+        while len(self._pending) > 0:
+            batch = [
+                self._pending.popleft()
+                for _ in range(min(self.BATCH_SIZE, len(self._pending)))
+            ]
+            vectors = await self.embed([d.text for d in batch], config)
+            if vectors is None:
+                # Try again later
+                self._pending.extendleft(reversed(batch))
+                return
+
+            self.messages.add(batch, vectors)
+            self._order.extend(d.key for d in batch)
+            while len(self.messages) > config.retrieval_max_documents:
+                self.messages.remove(self._order.popleft())
+
+
+retriever = Retriever()
@@ -0,0 +1,97 @@
+"""
+Choice of the model that answers a mention, so cheap messages don't
+take the time of a large model
+"""
+
+import logging
+import re
+
+import discord
+
+from . import botconf as _botconf
+from . import metrics as _metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUTE = "default"
+"""Name of the route of mentions that match no route"""
+
+_MENTION = re.compile(r"<@[!&]?\d+>")
+
+
+def _intent_matcher(route: _botconf.Route) -> re.Pattern[str] | None:
+    if len(route.intents) == 0:
+        return None
+    return re.compile(
+        r"\W*(?:" + "|".join(re.escape(i) for i in route.intents) + r")\b",
+        re.IGNORECASE,
+    )
+
+
+class Router:
+    """
+    Tries the `routes` of the config in order, and sends a mention to
+    the model of the first one that matches it, or to the `llm_model`
+    if none do
+    """
+
+    def __init__(self) -> None:
+        self._version = -1
+        self._intents: list[re.Pattern[str] | None] = []
+        self._default: _botconf.Route | None = None
+
+    def _compile(self, config: _botconf.BotConfig) -> None:
+        """
+        Compile the intents of the routes once per version of the config
+        """
+        if self._version == config.version:
+            return
+        self._intents = [_intent_matcher(r) for r in config.routes]
+        self._default = _botconf.Route(DEFAULT_ROUTE, config.llm_model)
+        self._version = config.version
+
+    def choose(
+        self,
+        message: discord.Message,
+        config: _botconf.BotConfig,
+    ) -> _botconf.Route:
+        """
+        Return the route of a mention
+        """
+        self._compile(config)
+        text = _MENTION.sub("", message.content).strip()
+
+        route = self._default
+        for r, intents in zip(config.routes, self._intents):
+            if (len(text) >= r.min_length
+                    and (r.max_length is None or len(text) <= r.max_length)
+                    and (r.has_code is None or r.has_code == ("```" in text))
+                    and (len(r.channels) == 0
+                         or message.channel.id in r.channels)
+                    and (intents is None or intents.match(text))):
+                route = r
+                break
+
+        assert route is not None
+        logger.info(
+            "route: %s (%s)",
+            route.name,
+            route.model,
+            extra={"route": route.name, "model": route.model},
+        )
+        _metrics.routes.inc(route=route.name, model=route.model)
+        return route
+
+
+def models(config: _botconf.BotConfig) -> list[str]:
+    """
+    Return every model mentions can be sent to, the `llm_model` first
+    """
+    result = [config.llm_model]
+    for route in config.routes:
+        if route.model not in result:
+            result.append(route.model)
+    return result
+
+
+router = Router()
@@ -0,0 +1,338 @@
+"""
+Fair scheduling of LLM generations across channels
+"""
+
+from collections import deque
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+import math
+import time
+
+from . import backends as _backends
+from . import botconf as _botconf
+from . import metrics as _metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A generation waiting for, or holding, a slot on the LLM backend
+    """
+    channel_id: int
+    run: Callable[[], Awaitable[Any]]
+    """Called to start the generation once the job gets a slot"""
+    message_id: int | None
+    """The message the generation answers"""
+    user_id: int | None
+    """The author of that message"""
+    status: str
+    """
+    One of "queued", "running", "done", "merged", "dropped" or
+    "cancelled"
+    """
+    enqueued_at: float
+    started_at: float | None
+
+    def __init__(
+        self,
+        channel_id: int,
+        run: Callable[[], Awaitable[Any]],
+        message_id: int | None = None,
+        user_id: int | None = None,
+    ) -> None:
+        self.channel_id = channel_id
+        self.run = run
+        self.message_id = message_id
+        self.user_id = user_id
+        self.status = "queued"
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self._future: asyncio.Future[Any] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def wait_time(self) -> float:
+        """Seconds the job spent (or has spent so far) in the queue"""
+        end = time.monotonic() if self.started_at is None else self.started_at
+        return end - self.enqueued_at
+
+    async def wait(self) -> Any:
+        """
+        Wait for the job to finish, and return the result of `run`.
+        If the job was merged into a newer job, or cancelled, return
+        None instead.
+        """
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            # Only swallow the cancellation of the job, not of the
+            # waiting task
+            if not self._future.cancelled():
+                raise
+            return None
+
+
+class GenerationScheduler:
+    """
+    Limits the number of generations in flight on the LLM backends, and
+    queues the rest per channel.
+    Queued jobs are started round-robin across channels, so a flood of
+    mentions in one channel can't starve quiet channels.
+
+    The limits are read from the bot config:
+    - `llm_max_concurrency`: generations in flight per backend
+    - `channel_queue_size`: jobs that can wait in a single channel
+    - `queue_overflow`: what to do when a channel's queue is full.
+      "merge" replaces the newest queued job of the channel with the
+      new one (its generation will see the same history anyway),
+      "drop" refuses the new job
+    """
+    in_flight: int
+    """Number of jobs currently running"""
+    wait_times: deque[float]
+    """Time spent queued by the most recently started jobs"""
+    run_time: float | None
+    """
+    Moving average of the seconds a job holds its slot for, or None if
+    no job has finished yet
+    """
+
+    RUN_TIME_SMOOTHING: float = 0.2
+    """Weight of the newest job in `run_time`"""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.wait_times = deque(maxlen=100)
+        self.run_time = None
+        self._queues: dict[int, deque[Job]] = {}
+        self._rotation: deque[int] = deque()
+        """Channels with queued jobs, in the order they will be served"""
+        self._by_message: dict[int, Job] = {}
+        self._by_user: dict[tuple[int, int], Job] = {}
+        """The newest job of each (user, channel)"""
+
+    @property
+    def capacity(self) -> int:
+        """
+        Maximum number of jobs in flight, across every available backend
+        """
+        return (
+            max(1, _botconf.bot_config.llm_max_concurrency) *
+            max(1, _backends.backend_pool.available_count())
+        )
+
+    def depth(self, channel_id: int | None = None) -> int:
+        """
+        Number of queued jobs in a channel, or in total if `channel_id`
+        is None
+        """
+        if channel_id is not None:
+            return len(self._queues.get(channel_id, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def expected_wait(self) -> float:
+        """
+        Estimate how many seconds a new job would wait for a slot, from
+        the number of jobs ahead of it and the average `run_time`
+        """
+        capacity = self.capacity
+        if self.in_flight < capacity or self.run_time is None:
+            return 0.0
+
+        # Slots free up in rounds of `capacity` jobs
+        ahead = self.depth() + 1
+        return math.ceil(ahead / capacity) * self.run_time
+
+    def stats(self) -> dict[str, Any]:
+        waits = list(self.wait_times)
+        return {
+            "in_flight": self.in_flight,
+            "capacity": self.capacity,
+            "queued": self.depth(),
+            "queued_channels": len(self._queues),
+            "avg_wait": sum(waits) / len(waits) if len(waits) > 0 else 0.0,
+            "max_wait": max(waits, default=0.0),
+            "run_time": self.run_time,
+        }
+
+    def submit(
+        self,
+        channel_id: int,
+        run: Callable[[], Awaitable[Any]],
+        message_id: int | None = None,
+        user_id: int | None = None,
+    ) -> Job | None:
+        """
+        Queue a generation for a channel, and start it as soon as there
+        is a free slot.
+        `message_id` and `user_id` identify the message being answered,
+        so the job can be cancelled with `cancel_message` and
+        `cancel_user`.
+        Return the job, or None if it was dropped because the channel's
+        queue is full.
+        """
+        job = Job(channel_id, run, message_id, user_id)
+        config = _botconf.bot_config
+        queue = self._queues.get(channel_id, deque())
+
+        if (self.in_flight >= self.capacity
+                and len(queue) >= config.channel_queue_size):
+            if config.queue_overflow != "merge" or len(queue) == 0:
+                job.status = "dropped"
+                _metrics.mentions.inc(channel=channel_id, outcome="dropped")
+                logger.info(
+                    "channel %d queue is full, dropping job",
+                    channel_id,
+                )
+                return None
+
+            merged = queue.pop()
+            merged.status = "merged"
+            merged._future.set_result(None)
+            self._forget(merged)
+            _metrics.mentions.inc(channel=channel_id, outcome="merged")
+            # Keep the merged job's place in the queue
+            job.enqueued_at = merged.enqueued_at
+            logger.info("channel %d queue is full, merging job", channel_id)
+
+        if channel_id not in self._queues:
+            self._queues[channel_id] = queue
+            self._rotation.append(channel_id)
+
+        queue.append(job)
+        if message_id is not None:
+            self._by_message[message_id] = job
+        if user_id is not None:
+            self._by_user[(user_id, channel_id)] = job
+        self._dispatch()
+        return job
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Remove a job from its queue, or stop it if it is running.
+        Return whether there was anything to cancel.
+        """
+        if job.status == "queued":
+            queue = self._queues.get(job.channel_id)
+            if queue is not None and job in queue:
+                # An empty queue is removed by `_dispatch`
+                queue.remove(job)
+            job.status = "cancelled"
+            job._future.cancel()
+            self._forget(job)
+        elif job.status == "running" and job._task is not None:
+            # `_finish` cleans up once the task is cancelled
+            job.status = "cancelled"
+            job._task.cancel()
+        else:
+            return False
+
+        _metrics.mentions.inc(channel=job.channel_id, outcome="cancelled")
+        logger.info("cancelled job for channel %d", job.channel_id)
+        return True
+
+    def cancel_message(self, message_id: int) -> bool:
+        """
+        Cancel the job answering a message, if there is one
+        """
+        job = self._by_message.get(message_id)
+        return job is not None and self.cancel(job)
+
+    def cancel_user(self, user_id: int, channel_id: int) -> bool:
+        """
+        Cancel the newest job answering a user in a channel, if there is
+        one
+        """
+        job = self._by_user.get((user_id, channel_id))
+        return job is not None and self.cancel(job)
+
+    def _forget(self, job: Job) -> None:
+        if (job.message_id is not None
+                and self._by_message.get(job.message_id) is job):
+            del self._by_message[job.message_id]
+        key = (job.user_id or 0, job.channel_id)
+        if job.user_id is not None and self._by_user.get(key) is job:
+            del self._by_user[key]
+
+    def _dispatch(self) -> None:
+        """
+        Start queued jobs, round-robin across channels, until every
+        slot is taken
+        """
+        while len(self._rotation) > 0 and self.in_flight < self.capacity:
+            channel_id = self._rotation.popleft()
+            queue = self._queues[channel_id]
+            if len(queue) == 0:
+                del self._queues[channel_id]
+                continue
+
+            job = queue.popleft()
+            if len(queue) > 0:
+                self._rotation.append(channel_id)
+            else:
+                del self._queues[channel_id]
+
+            self._start(job)
+
+    def _start(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.monotonic()
+        self.wait_times.append(job.wait_time)
+        _metrics.queue_wait.observe(job.wait_time, channel=job.channel_id)
+        self.in_flight += 1
+        logger.info(
+            "starting job for channel %d after waiting %.3f seconds " +
+            "(%d still queued)",
+            job.channel_id,
+            job.wait_time,
+            self.depth(),
+        )
+        job._task = asyncio.create_task(self._run(job))
+        # A callback rather than a `finally`, so the job is cleaned up
+        # even if its task is cancelled before it starts running
+        job._task.add_done_callback(lambda _: self._finish(job))
+
+    async def _run(self, job: Job) -> None:
+        try:
+            result = await job.run()
+        except Exception as e:
+            logger.error(f"{type(e)}: {e}")
+            _metrics.errors.inc(stage="generation")
+            job._future.set_exception(e)
+        else:
+            job._future.set_result(result)
+
+    def _finish(self, job: Job) -> None:
+        """
+        Free the slot of a job whose task has ended, and start the next
+        queued job
+        """
+        if job._task is not None and job._task.cancelled():
+            job.status = "cancelled"
+            job._future.cancel()
+
+        # A cancelled job was cut short, so its run time says nothing
+        # about how long generations take
+        if job.status != "cancelled":
+            job.status = "done"
+            self._record_run_time(job)
+        self._forget(job)
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _record_run_time(self, job: Job) -> None:
+        assert job.started_at is not None
+        run_time = time.monotonic() - job.started_at
+        if self.run_time is None:
+            self.run_time = run_time
+        else:
+            self.run_time += self.RUN_TIME_SMOOTHING * (
+                run_time - self.run_time
+            )
+
+
+generation_scheduler = GenerationScheduler()
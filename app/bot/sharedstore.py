@@ -0,0 +1,263 @@
+"""
+State shared by the worker processes of a sharded bot
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import asyncio
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    kind TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS response_cache_used ON response_cache (used_at);
+"""
+
+Bucket = tuple[str, int, float, float]
+"""(kind, key, rate, burst) of a token bucket, with `rate` per second"""
+
+
+class SharedStore:
+    """
+    Keeps the token buckets of the rate limits and the response cache in
+    an SQLite database, so every worker process sees the same state
+    whichever shard receives a mention.
+
+    Every operation is a single transaction, run on a dedicated thread
+    so the event loop never waits on SQLite. Times are `time.time()`,
+    as monotonic clocks can't be compared between processes.
+    """
+    PRUNE_EVERY: int = 1024
+    """Operations between removals of stale rows"""
+
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="sharedstore",
+        )
+        self._operations = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def open(self) -> None:
+        if self._conn is not None:
+            return
+
+        self._conn = await self._run(self._connect)
+        logger.info(f"opened shared database {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are started explicitly, so they can lock the
+        # database before reading
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=10.0,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    async def close(self) -> None:
+        if self._conn is None:
+            return
+
+        conn = self._conn
+        self._conn = None
+        await self._run(conn.close)
+        self._executor.shutdown(wait=False)
+        logger.info("closed shared database")
+
+    def _prune_due(self) -> bool:
+        self._operations += 1
+        return self._operations % self.PRUNE_EVERY == 0
+
+    async def take(
+        self,
+        buckets: list[Bucket],
+        now: float,
+    ) -> tuple[str, float] | None:
+        """
+        Take a token from every bucket if they all have one.
+        Return None if they did, otherwise the kind of the first bucket
+        without a token, and the number of seconds until it has one.
+        """
+        return await self._run(self._take, buckets, now, self._prune_due())
+
+    def _take(
+        self,
+        buckets: list[Bucket],
+        now: float,
+        prune: bool,
+    ) -> tuple[str, float] | None:
+        conn = self._conn
+        if conn is None:
+            return None
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens = []
+            for kind, key, rate, burst in buckets:
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM rate_buckets" +
+                    " WHERE kind = ? AND key = ?",
+                    (kind, key),
+                ).fetchone()
+                t = burst if row is None else min(
+                    burst,
+                    row[0] + max(0.0, now - row[1]) * rate,
+                )
+                if t < 1:
+                    conn.execute("ROLLBACK")
+                    return kind, (1 - t) / rate
+                tokens.append(t)
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_buckets" +
+                " (kind, key, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                [
+                    (kind, key, t - 1, now)
+                    for (kind, key, _, _), t in zip(buckets, tokens)
+                ],
+            )
+            if prune:
+                # A bucket that has had time to fill up is the same as a
+                # new one
+                for kind, _, rate, burst in buckets:
+                    conn.execute(
+                        "DELETE FROM rate_buckets" +
+                        " WHERE kind = ? AND updated_at < ?",
+                        (kind, now - burst / rate),
+                    )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    async def cache_get(self, key: str, now: float) -> str | None:
+        """
+        Return the cached response for `key`, or None if there is none
+        """
+        return await self._run(self._cache_get, key, now)
+
+    def _cache_get(self, key: str, now: float) -> str | None:
+        conn = self._conn
+        if conn is None:
+            return None
+
+        row = conn.execute(
+            "SELECT response, expires_at FROM response_cache WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        response, expires_at = row
+        if now >= expires_at:
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            return None
+        conn.execute(
+            "UPDATE response_cache SET used_at = ? WHERE key = ?",
+            (now, key),
+        )
+        return response
+
+    async def cache_put(
+        self,
+        key: str,
+        response: str,
+        now: float,
+        ttl: float,
+        size: int,
+    ) -> None:
+        """
+        Cache a response for `ttl` seconds, keeping at most `size`
+        responses, dropping the least recently used
+        """
+        await self._run(
+            self._cache_put, key, response, now, ttl, size, self._prune_due(),
+        )
+
+    def _cache_put(
+        self,
+        key: str,
+        response: str,
+        now: float,
+        ttl: float,
+        size: int,
+        prune: bool,
+    ) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache" +
+                " (key, response, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, response, now + ttl, now),
+            )
+            if prune:
+                conn.execute(
+                    "DELETE FROM response_cache WHERE expires_at <= ?",
+                    (now,),
+                )
+            conn.execute(
+                "DELETE FROM response_cache WHERE key IN (" +
+                "SELECT key FROM response_cache ORDER BY used_at DESC" +
+                " LIMIT -1 OFFSET ?)",
+                (max(0, size),),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+shared_store: SharedStore | None = None
+"""The shared store, if the bot runs in several processes"""
+
+
+async def open_shared_store(path: str) -> SharedStore:
+    """
+    Start sharing state through the SQLite database at `path`
+    """
+    global shared_store
+
+    if shared_store is None:
+        shared_store = SharedStore(path)
+    await shared_store.open()
+    return shared_store
+
+
+async def close_shared_store() -> None:
+    if shared_store is not None:
+        await shared_store.close()
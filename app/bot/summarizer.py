@@ -0,0 +1,163 @@
+"""
+Background summarization of the older part of long conversations, so
+prompts stay short however long a conversation runs
+"""
+
+import asyncio
+import logging
+import time
+
+from . import botconf as _botconf
+from . import bothist as _bothist
+from . import llm as _llm
+from . import metrics as _metrics
+from . import scheduler as _scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class Summarizer:
+    """
+    While no response is being generated, folds the history entries of
+    a channel that are older than its last `summary_keep_recent`
+    entries into the channel's summary, once at least
+    `summary_min_new` of them aren't included in it yet.
+    The summary is then sent instead of those entries.
+
+    A summary is stopped (and retried later) as soon as a mention needs
+    the LLM, see `interrupt`.
+    """
+    INTERVAL: float = 10.0
+    """Seconds between checks for channels to summarize"""
+
+    def __init__(self) -> None:
+        self._task: asyncio.Task[None] | None = None
+        self._summarizing: asyncio.Task[bool] | None = None
+        self._interrupted = False
+
+    def start(self) -> None:
+        """
+        Start summarizing in the background.
+        Does nothing if it has already been started.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        self.interrupt()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def interrupt(self) -> None:
+        """
+        Stop the summary being generated, if any, to free the LLM
+        """
+        if self._summarizing is not None and not self._summarizing.done():
+            self._interrupted = True
+            self._summarizing.cancel()
+            _metrics.summaries.inc(outcome="interrupted")
+            logger.info("summary interrupted")
+
+    def _idle(self) -> bool:
+        scheduler = _scheduler.generation_scheduler
+        return scheduler.in_flight == 0 and scheduler.depth() == 0
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            config = _botconf.bot_config
+            if not config.summarize_history:
+                continue
+
+            # Summarize channels one by one, as long as nothing else
+            # needs the LLM
+            for chan_id in reversed(
+                list(_bothist.bot_history.message_histories)
+            ):
+                if not self._idle():
+                    break
+                if not self._needs_summary(chan_id, config):
+                    continue
+
+                self._interrupted = False
+                self._summarizing = asyncio.create_task(
+                    self.summarize(chan_id, config)
+                )
+                try:
+                    await self._summarizing
+                except asyncio.CancelledError:
+                    # Interrupted, so stop until the next check, unless
+                    # this task is the one being cancelled
+                    if self._task is None or not self._interrupted:
+                        raise
+                    break
+                finally:
+                    self._summarizing = None
+
+    def _pending(
+        self,
+        chan_id: int,
+        config: _botconf.BotConfig,
+    ) -> list[_bothist.HistoryEntry]:
+        """
+        Return the entries of a channel that should be added to its
+        summary
+        """
+        entries = _bothist.bot_history.entries(chan_id)
+        summary = _bothist.bot_history.summary(chan_id)
+        if summary is not None:
+            upto = summary.upto
+            new = [e for e in entries if e.timestamp > upto]
+        else:
+            new = list(entries)
+
+        keep = max(1, config.summary_keep_recent)
+        return new[:-keep]
+
+    def _needs_summary(
+        self,
+        chan_id: int,
+        config: _botconf.BotConfig,
+    ) -> bool:
+        return (
+            len(self._pending(chan_id, config)) >=
+            max(1, config.summary_min_new)
+        )
+
+    async def summarize(
+        self,
+        chan_id: int,
+        config: _botconf.BotConfig,
+    ) -> bool:
+        """
+        Add the entries of a channel that are old enough to its summary.
+        Return whether the summary was updated.
+        """
+        pending = self._pending(chan_id, config)
+        if len(pending) == 0:
+            return False
+
+        summary = _bothist.bot_history.summary(chan_id)
+        previous = summary.content if summary is not None else ""
+
+        started = time.monotonic()
+        content = await _llm.generate_summary(previous, pending, config)
+        if content is None or content == "":
+            _metrics.summaries.inc(outcome="failed")
+            return False
+
+        await _bothist.bot_history.set_summary(
+            chan_id,
+            content,
+            pending[-1].timestamp,
+        )
+        _metrics.summaries.inc(outcome="updated")
+        logger.info(
+            f"summarized {len(pending)} messages of channel {chan_id} in " +
+            f"{time.monotonic() - started:.3f} seconds"
+        )
+        return True
+
+
+summarizer = Summarizer()
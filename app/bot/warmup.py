@@ -0,0 +1,127 @@
+"""
+Preloading of the LLM models, so mentions don't wait for them to load
+"""
+
+from datetime import datetime
+import asyncio
+import logging
+
+import aiohttp
+
+from . import backends as _backends
+from . import botconf as _botconf
+from . import llm as _llm
+from . import routing as _routing
+
+logger = logging.getLogger(__name__)
+
+
+def in_active_hours(spec: str, now: datetime | None = None) -> bool:
+    """
+    Check whether the hour of `now` (the current local time by default)
+    is within `spec`, a range of hours like `8-22`.
+    Ranges can wrap around midnight (e.g. `20-2`), and an empty `spec`
+    means every hour.
+    """
+    if spec.strip() == "":
+        return True
+
+    try:
+        start, end = (int(h) % 24 for h in spec.split("-", 1))
+    except ValueError:
+        logger.warning(f"Invalid keep_warm_hours: {spec}")
+        return True
+
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class ModelWarmer:
+    """
+    Loads the models (the `llm_model` and the models of the `routes`) on
+    every LLM server in the background when the bot starts, then
+    optionally pings the servers every `keep_warm_interval` seconds
+    during `keep_warm_hours`, so the models aren't unloaded while people
+    are likely to mention the bot.
+    """
+
+    def __init__(self) -> None:
+        self._warm_up_task: asyncio.Task[None] | None = None
+        self._keep_warm_task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        """
+        Start warming up in the background.
+        Does nothing if it has already been started.
+        """
+        if self._warm_up_task is None or self._warm_up_task.done():
+            self._warm_up_task = asyncio.create_task(self.warm_up())
+
+        if self._keep_warm_task is None or self._keep_warm_task.done():
+            self._keep_warm_task = asyncio.create_task(self._keep_warm())
+
+    async def stop(self) -> None:
+        for task in (self._warm_up_task, self._keep_warm_task):
+            if task is not None:
+                task.cancel()
+        self._warm_up_task = None
+        self._keep_warm_task = None
+
+    async def warm_up(self) -> None:
+        """
+        Load the models on every available server
+        """
+        models = _routing.models(_botconf.bot_config)
+        await asyncio.gather(*[
+            self._load(backend, model)
+            for backend in _backends.backend_pool.backends
+            if backend.available
+            for model in models
+        ])
+
+    async def _load(self, backend: _backends.Backend, model: str) -> None:
+        # A generate request without a prompt only loads the model
+        url = f"{backend.url}/api/generate"
+        try:
+            async with _llm.llm_client.session.post(url, json={
+                "model": model,
+                "keep_alive": _botconf.bot_config.llm_keep_alive,
+            }) as res:
+                data = await res.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(
+                f"failed to warm up {model} on {backend.url}: " +
+                f"{type(e)}: {e}"
+            )
+            return
+
+        if "error" in data:
+            logger.warning(
+                f"failed to warm up {model} on {backend.url}: " +
+                f"{data['error']}"
+            )
+            return
+
+        backend.loaded_models.add(_backends.normalize_model(model))
+        load = data.get("load_duration", 0) / 1_000_000_000
+        logger.info(
+            f"warmed up {model} on {backend.url}, loading took " +
+            f"{load:.3f} seconds"
+        )
+
+    async def _keep_warm(self) -> None:
+        while True:
+            config = _botconf.bot_config
+            if config.keep_warm_interval <= 0:
+                # Disabled, but check again later in case it is enabled
+                await asyncio.sleep(60)
+                continue
+
+            await asyncio.sleep(config.keep_warm_interval)
+            if in_active_hours(_botconf.bot_config.keep_warm_hours):
+                await self.warm_up()
+
+
+model_warmer = ModelWarmer()
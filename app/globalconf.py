@@ -11,15 +11,58 @@ ROOT_DIR: str = _os.path.join(
 )
 DATA_DIR: str = _os.path.join(ROOT_DIR, "data")
 DB_FILE: str = _os.path.join(DATA_DIR, "data.db")
+# State shared by the worker processes, when there are several
+SHARED_DB_FILE: str = _os.path.join(DATA_DIR, "shared.db")
 CONFIG_FILE: str = _os.path.join(DATA_DIR, "config.yaml")
 DEFAULT_CONFIG_FILE: str = _os.path.join(
     _os.path.dirname(__file__),
     "default-config.yaml",
 )
+# Seconds between checks for changes of the config files
+# (0 to never reload the config)
+CONFIG_POLL_INTERVAL: float = 5.0
+
+# Sharding
+# Number of gateway shards, or None to let Discord choose when sharded
+SHARD_COUNT: int | None = None
+# Number of processes to split the shards between
+WORKERS: int = 1
+# Shards run by this process, or None for all of them
+SHARD_IDS: list[int] | None = None
+
+
+def is_sharded() -> bool:
+    return SHARD_COUNT is not None or WORKERS > 1
+
 
 # LLM server config
 LLM_HOST: str = "localhost"
 LLM_PORT: int = 11434
+# Base URLs of every LLM server to use. Defaults to the one at
+# LLM_HOST and LLM_PORT
+LLM_BACKENDS: list[str] = []
+# Seconds between health checks of the LLM servers
+LLM_HEALTH_INTERVAL: float = 15.0
+# Maximum number of pooled connections to the LLM server
+LLM_MAX_CONNECTIONS: int = 8
+# Seconds an idle pooled connection is kept open
+LLM_KEEPALIVE_TIMEOUT: float = 60.0
+# Seconds to wait when establishing a connection to the LLM server
+LLM_CONNECT_TIMEOUT: float = 5.0
+# Seconds to wait between reads from the LLM server
+# (i.e. how long generation may stall before giving up)
+LLM_READ_TIMEOUT: float = 300.0
+
+# Metrics
+# Port to serve Prometheus metrics on, or None to not serve them
+METRICS_PORT: int | None = None
+METRICS_HOST: str = "127.0.0.1"
 
 # Logging
 LOG_LEVEL: str | None = None
+# `text`, or `json` for a JSON object per line
+LOG_FORMAT: str = "text"
+# Longest string logged as an argument or field (0 for no limit)
+LOG_MAX_CHARS: int = 2000
+# Fraction of the records of frequent events that are logged
+LOG_SAMPLE_RATE: float = 1.0
@@ -0,0 +1,169 @@
+"""
+Logging that formats and writes records on a background thread, so
+logging never blocks the event loop
+"""
+
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+"""Attributes of every log record, as opposed to `extra` fields"""
+
+
+class lazy:
+    """
+    A log argument or field that is only computed if the record is
+    written, on the logging thread, e.g.
+    `logger.info("messages: %s", lazy(preview, messages))`
+    """
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn: Callable[..., Any], *args: Any) -> None:
+        self.fn = fn
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.fn(*self.args))
+
+
+def _truncate(value: Any, max_chars: int) -> Any:
+    if isinstance(value, lazy):
+        value = str(value)
+    if isinstance(value, str) and 0 < max_chars < len(value):
+        return (
+            value[:max_chars] +
+            f"... ({len(value) - max_chars} more characters)"
+        )
+    return value
+
+
+class TruncatingFormatter(logging.Formatter):
+    """
+    Formats records like `logging.Formatter`, but cuts string arguments
+    longer than `max_chars` characters
+    """
+
+    def __init__(self, fmt: str | None = None, max_chars: int = 0) -> None:
+        super().__init__(fmt)
+        self.max_chars = max_chars
+
+    def _truncated(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, tuple):
+            record = logging.makeLogRecord(record.__dict__)
+            record.args = tuple(
+                _truncate(a, self.max_chars) for a in record.args
+            )
+        return record
+
+    def format(self, record: logging.LogRecord) -> str:
+        return super().format(self._truncated(record))
+
+
+class JsonFormatter(TruncatingFormatter):
+    """
+    Formats records as a JSON object per line, with the `extra` fields
+    of the record as keys
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        record = self._truncated(record)
+        entry: dict[str, Any] = {
+            "time": time.strftime(
+                "%Y-%m-%dT%H:%M:%S",
+                time.gmtime(record.created),
+            ) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = _truncate(value, self.max_chars)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction `rate` of the records logged with
+    `extra={"sampled": True}`, and every other record
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave formatting to the listener's thread. The record doesn't
+        # leave the process, so it doesn't need to be picklable.
+        return record
+
+
+def setup_logging(
+    level: str | None,
+    json_format: bool = False,
+    max_chars: int = 0,
+    sample_rate: float = 1.0,
+) -> QueueListener:
+    """
+    Send the records of every logger to a queue, from which a background
+    thread formats them (as JSON if `json_format` is True, with strings
+    cut to `max_chars` characters) and writes them to stderr.
+    Records logged as sampled are kept with a probability of
+    `sample_rate`.
+    Return the listener of the queue, which is stopped at exit.
+    """
+    formatter: logging.Formatter
+    if json_format:
+        formatter = JsonFormatter(max_chars=max_chars)
+    else:
+        formatter = TruncatingFormatter(
+            logging.BASIC_FORMAT,
+            max_chars=max_chars,
+        )
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+
+    # An unbounded queue, so logging never waits for the writer
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    if level is not None:
+        root.setLevel(level)
+
+    listener = QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+
+    def stop() -> None:
+        # Write the remaining records, unless already stopped
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(stop)
+    return listener
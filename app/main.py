@@ -4,11 +4,13 @@ The main entrypoint to the bot
 
 import os
 import logging
+import multiprocessing
 
 from dotenv import load_dotenv
 
 # -------- Config --------
 import globalconf
+import logsetup
 
 # Load .env variables into environment
 load_dotenv()
@@ -24,13 +26,39 @@ if (log_level is not None and log_level.upper()
 
 globalconf.LOG_LEVEL = log_level
 
-logging.basicConfig(
-    level=globalconf.LOG_LEVEL
+log_format = os.getenv("LOG_FORMAT")
+if log_format is not None and log_format != "":
+    if log_format.lower() in ("text", "json"):
+        globalconf.LOG_FORMAT = log_format.lower()
+    else:
+        print(f"LOG_FORMAT `{log_format}` is invalid")
+
+for log_var, log_type in (
+    ("LOG_MAX_CHARS", int),
+    ("LOG_SAMPLE_RATE", float),
+):
+    log_value = os.getenv(log_var)
+    if log_value is None or log_value == "":
+        continue
+    try:
+        setattr(globalconf, log_var, log_type(log_value))
+    except ValueError:
+        print(f"{log_var} `{log_value}` is invalid")
+
+# Records are formatted and written on a background thread
+logsetup.setup_logging(
+    globalconf.LOG_LEVEL,
+    json_format=globalconf.LOG_FORMAT == "json",
+    max_chars=globalconf.LOG_MAX_CHARS,
+    sample_rate=globalconf.LOG_SAMPLE_RATE,
 )
 if globalconf.LOG_LEVEL is not None:
     logger.setLevel(globalconf.LOG_LEVEL)
 
 logger.info(f"LOG_LEVEL={globalconf.LOG_LEVEL}")
+logger.info(f"LOG_FORMAT={globalconf.LOG_FORMAT}")
+logger.info(f"LOG_MAX_CHARS={globalconf.LOG_MAX_CHARS}")
+logger.info(f"LOG_SAMPLE_RATE={globalconf.LOG_SAMPLE_RATE}")
 
 # Load configuration from environment
 globalconf.DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
@@ -65,6 +93,15 @@ logger.info(
     f"DEFAULT_CONFIG_FILE={os.path.abspath(globalconf.DEFAULT_CONFIG_FILE)}"
 )
 
+config_poll_interval = os.getenv("CONFIG_POLL_INTERVAL")
+if config_poll_interval is not None and config_poll_interval != "":
+    try:
+        globalconf.CONFIG_POLL_INTERVAL = float(config_poll_interval)
+    except ValueError:
+        logger.warning("CONFIG_POLL_INTERVAL is an invalid number. Ignoring")
+
+logger.info(f"CONFIG_POLL_INTERVAL={globalconf.CONFIG_POLL_INTERVAL}")
+
 # Create file if it doesn't exist
 if not os.path.exists(globalconf.CONFIG_FILE):
     logger.info(f"file doesn't exist: {globalconf.CONFIG_FILE}, creating...")
@@ -82,24 +119,161 @@ if llm_port is not None:
     except ValueError:
         globalconf.LLM_PORT = 11434
 
+# Comma separated list of `host:port` (or URLs) of every LLM server
+llm_hosts = os.getenv("LLM_HOSTS")
+if llm_hosts is not None and llm_hosts.strip() != "":
+    for llm_backend in llm_hosts.split(","):
+        llm_backend = llm_backend.strip()
+        if llm_backend == "":
+            continue
+        if not llm_backend.startswith(("http://", "https://")):
+            llm_backend = "http://" + llm_backend
+        globalconf.LLM_BACKENDS.append(llm_backend)
+else:
+    globalconf.LLM_BACKENDS.append(
+        f"http://{globalconf.LLM_HOST}:{globalconf.LLM_PORT}"
+    )
+
+llm_max_connections = os.getenv("LLM_MAX_CONNECTIONS")
+if llm_max_connections is not None:
+    try:
+        globalconf.LLM_MAX_CONNECTIONS = int(llm_max_connections)
+    except ValueError:
+        logger.warning("LLM_MAX_CONNECTIONS is an invalid integer. Ignoring")
+
+for timeout_var in (
+    "LLM_HEALTH_INTERVAL",
+    "LLM_KEEPALIVE_TIMEOUT",
+    "LLM_CONNECT_TIMEOUT",
+    "LLM_READ_TIMEOUT",
+):
+    timeout_value = os.getenv(timeout_var)
+    if timeout_value is None:
+        continue
+    try:
+        setattr(globalconf, timeout_var, float(timeout_value))
+    except ValueError:
+        logger.warning(f"{timeout_var} is an invalid number. Ignoring")
+
 logger.info(f"LLM_HOST={globalconf.LLM_HOST}")
 logger.info(f"LLM_PORT={globalconf.LLM_PORT}")
+logger.info(f"LLM_BACKENDS={globalconf.LLM_BACKENDS}")
+logger.info(f"LLM_MAX_CONNECTIONS={globalconf.LLM_MAX_CONNECTIONS}")
+logger.info(
+    f"LLM_CONNECT_TIMEOUT={globalconf.LLM_CONNECT_TIMEOUT}, " +
+    f"LLM_READ_TIMEOUT={globalconf.LLM_READ_TIMEOUT}, " +
+    f"LLM_KEEPALIVE_TIMEOUT={globalconf.LLM_KEEPALIVE_TIMEOUT}"
+)
 
+# Metrics config
+metrics_port = os.getenv("METRICS_PORT")
+if metrics_port is not None and metrics_port != "":
+    try:
+        globalconf.METRICS_PORT = int(metrics_port)
+    except ValueError:
+        logger.warning(
+            "METRICS_PORT is an invalid integer. Not serving metrics"
+        )
 
-# -------- Main --------
+metrics_host = os.getenv("METRICS_HOST")
+if metrics_host is not None and metrics_host != "":
+    globalconf.METRICS_HOST = metrics_host
 
-# Import internal modules that depend on configuration after changes
-import bot  # TODO: Why can't I do `from . import bot`?
-from bot import botconf
+logger.info(f"METRICS_PORT={globalconf.METRICS_PORT}")
+logger.info(f"METRICS_HOST={globalconf.METRICS_HOST}")
 
-with open(globalconf.CONFIG_FILE, "r") as f:
-    botconf.bot_config.load_from_file(f)
+# Sharding config
+shard_count = os.getenv("SHARD_COUNT")
+if shard_count is not None and shard_count != "":
+    try:
+        globalconf.SHARD_COUNT = int(shard_count)
+    except ValueError:
+        logger.warning("SHARD_COUNT is an invalid integer. Ignoring")
+
+workers = os.getenv("WORKERS")
+if workers is not None and workers != "":
+    try:
+        globalconf.WORKERS = max(1, int(workers))
+    except ValueError:
+        logger.warning("WORKERS is an invalid integer. Ignoring")
 
-# Run bot
-try:
-    bot.client.run(
-        globalconf.DISCORD_TOKEN,
-        log_handler=None,
+if globalconf.WORKERS > 1:
+    # Every worker needs at least one shard
+    globalconf.SHARD_COUNT = max(
+        globalconf.SHARD_COUNT or globalconf.WORKERS,
+        globalconf.WORKERS,
     )
-except KeyboardInterrupt:
-    print("Ctrl-C: Exiting")  # Exit cleanly in case of a KeyboardInterrupt
+
+logger.info(f"SHARD_COUNT={globalconf.SHARD_COUNT}")
+logger.info(f"WORKERS={globalconf.WORKERS}")
+logger.info(f"SHARED_DB_FILE={os.path.abspath(globalconf.SHARED_DB_FILE)}")
+
+
+# -------- Main --------
+
+def run_bot() -> None:
+    # Import internal modules that depend on configuration after changes
+    import bot  # TODO: Why can't I do `from . import bot`?
+    from bot import botconf
+
+    with open(globalconf.CONFIG_FILE, "r") as f:
+        botconf.load_config(f)
+
+    # Run bot
+    try:
+        bot.client.run(
+            globalconf.DISCORD_TOKEN,
+            log_handler=None,
+        )
+    except KeyboardInterrupt:
+        # Exit cleanly in case of a KeyboardInterrupt
+        print("Ctrl-C: Exiting")
+
+
+def run_worker(index: int, shard_ids: list[int]) -> None:
+    """
+    Run the bot with some of the shards, in a worker process.
+    The config above has been loaded again when the worker started.
+    """
+    globalconf.SHARD_IDS = shard_ids
+    if globalconf.METRICS_PORT is not None:
+        # Every worker serves its own metrics
+        globalconf.METRICS_PORT += index
+    run_bot()
+
+
+def run_workers() -> None:
+    """
+    Split the shards between `WORKERS` processes, and run them until
+    they all exit
+    """
+    assert globalconf.SHARD_COUNT is not None
+    shards = list(range(globalconf.SHARD_COUNT))
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(i, shards[i::globalconf.WORKERS]),
+            name=f"worker-{i}",
+        )
+        for i in range(globalconf.WORKERS)
+    ]
+
+    for p in processes:
+        p.start()
+        logger.info(f"started {p.name} (pid {p.pid})")
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        print("Ctrl-C: Exiting")
+        for p in processes:
+            p.join()
+
+
+# Worker processes import this file too, to load the config
+if __name__ == "__main__":
+    if globalconf.WORKERS > 1:
+        run_workers()
+    else:
+        run_bot()
@@ -0,0 +1,60 @@
+"""
+Pulling models onto the stub Ollama server
+"""
+
+import asyncio
+import os
+import sys
+
+import aiohttp
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(_ROOT, "app"))
+sys.path.insert(0, os.path.join(_ROOT, "tools"))
+
+import ollama_stub  # noqa: E402
+
+from bot import backends, modelpull  # noqa: E402
+
+
+async def _pull(config: ollama_stub.StubConfig) -> tuple[
+    modelpull.ModelPuller,
+    backends.Backend,
+    modelpull.PullProgress,
+]:
+    runner, url = await ollama_stub.start(config)
+    try:
+        async with aiohttp.ClientSession() as session:
+            puller = modelpull.ModelPuller()
+            puller.start(session)
+            backend = backends.Backend(url)
+            puller.pull(backend, "phi3")
+            assert puller.is_pulling("phi3")
+            await asyncio.wait_for(puller.wait("phi3"), 10)
+            return puller, backend, puller.progress[(url, "phi3:latest")]
+    finally:
+        await runner.cleanup()
+
+
+def test_pull() -> None:
+    puller, backend, progress = asyncio.run(
+        _pull(ollama_stub.StubConfig())
+    )
+
+    assert progress.done
+    assert progress.error is None
+    assert progress.status == "success"
+    assert "phi3:latest" in backend.models
+    assert not puller.is_pulling("phi3")
+
+
+def test_pull_truncated_progress() -> None:
+    puller, backend, progress = asyncio.run(
+        _pull(ollama_stub.StubConfig(truncate_pull=True))
+    )
+
+    assert progress.done
+    assert progress.error is not None
+    assert "phi3:latest" not in backend.models
+    assert not puller.is_pulling("phi3")
+    assert len(puller._tasks) == 0
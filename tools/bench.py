@@ -0,0 +1,285 @@
+"""
+Micro-benchmarks of the helpers that run on every message or reply.
+
+Every benchmark runs on a fixed, generated input corpus, so results are
+comparable between runs on the same machine.
+
+Usage:
+    python tools/bench.py --save baseline.json
+    (make changes)
+    python tools/bench.py --compare baseline.json
+"""
+
+from datetime import datetime, timezone
+from typing import Callable
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+import yaml
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"),
+)
+
+import globalconf  # noqa: E402
+import bot  # noqa: E402
+from bot import botconf  # noqa: E402
+from bot import bothist  # noqa: E402
+from bot import llm  # noqa: E402
+
+_rng = random.Random(0)
+
+
+class _User:
+    def __init__(self, i: int) -> None:
+        self.id = i
+        self.display_name = f"user{i}"
+        self.mention = f"<@{i}>"
+
+
+class _Channel:
+    def __init__(self, i: int) -> None:
+        self.id = i
+
+
+class _Message:
+    def __init__(
+        self,
+        content: str,
+        channel: _Channel,
+        author: _User,
+        mentions: list[_User],
+    ) -> None:
+        self.id = _rng.getrandbits(63)
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.mentions = mentions
+        self.created_at = datetime.now(timezone.utc)
+
+
+def _words(n: int) -> str:
+    return " ".join(
+        _rng.choice(("raspberry", "pi", "gpio", "the", "a", "sudo", "apt"))
+        for _ in range(n)
+    )
+
+
+def _code_reply() -> str:
+    """A long reply, mostly made of code with few spaces"""
+    parts = []
+    for _ in range(12):
+        parts.append(_words(40))
+        parts.append("```python\n" + "\n".join(
+            f"x{i}=gpio.read({i});print(f'{{x{i}}}')" for i in range(30)
+        ) + "\n```")
+    return "\n".join(parts)
+
+
+def _bench_split_text() -> Callable[[], object]:
+    replies = [_code_reply() for _ in range(10)]
+
+    def run() -> None:
+        for r in replies:
+            bot._split_text(r)
+    return run
+
+
+def _bench_is_greeting() -> Callable[[], object]:
+    me = _User(0)
+    bot.client._connection.user = me  # type: ignore
+    channel = _Channel(1)
+    messages = [
+        _Message(
+            _rng.choice(("Hello", "hey", "so", "hi", "what")) + " " +
+            _words(10),
+            channel,
+            _User(i),
+            [me] if i % 2 == 0 else [],
+        )
+        for i in range(1000)
+    ]
+
+    def run() -> None:
+        for m in messages:
+            bot._is_greeting(m)  # type: ignore[arg-type]
+    return run
+
+
+def _bench_is_command() -> Callable[[], object]:
+    texts = [
+        _rng.choice(("!help", "!r", "", "hello ")) + _words(5)
+        for _ in range(1000)
+    ]
+
+    def run() -> None:
+        for t in texts:
+            bot._is_command(t)
+    return run
+
+
+def _bench_add_message() -> Callable[[], object]:
+    history = bothist.MessageHistory()
+    channels = [_Channel(i) for i in range(10_000)]
+    users = [_User(i) for i in range(500)]
+    messages = [
+        _Message(_words(20), _rng.choice(channels), _rng.choice(users), [])
+        for _ in range(10_000)
+    ]
+
+    def run() -> None:
+        for m in messages:
+            history.add_message([m])  # type: ignore[list-item]
+    return run
+
+
+def _bench_merge_configs() -> Callable[[], object]:
+    with open(globalconf.DEFAULT_CONFIG_FILE, "r") as f:
+        default_config = yaml.safe_load(f)
+    user_config = {
+        "resources": [
+            {
+                "name": f"Resource {i}",
+                "link": f"example.com/{i}",
+                "desc": _words(8),
+            }
+            for i in range(2000)
+        ],
+        "system_prompt": _words(200),
+    }
+
+    def run() -> None:
+        botconf._merge_configs(user_config, default_config)
+    return run
+
+
+def _bench_parse_config() -> Callable[[], object]:
+    user_config = yaml.safe_dump({
+        "resources": [
+            {
+                "name": f"Resource {i}",
+                "link": f"example.com/{i}",
+                "desc": _words(8),
+            }
+            for i in range(200)
+        ],
+        "system_prompt": _words(200),
+    })
+
+    def run() -> None:
+        botconf.parse_config(io.StringIO(user_config))
+    return run
+
+
+def _fill_history() -> tuple[_Message, str]:
+    history = bothist.bot_history
+    channel = _Channel(42)
+    users = [_User(i) for i in range(20)]
+    for _ in range(botconf.bot_config.history_length):
+        history.add_message([  # type: ignore[list-item]
+            _Message(_words(60), channel, _rng.choice(users), [])
+        ])
+    message = _Message(_words(20), channel, users[0], [])
+    system_prompt = _words(150)
+    return message, system_prompt
+
+
+def _bench_build_messages() -> Callable[[], object]:
+    message, system_prompt = _fill_history()
+
+    def run() -> None:
+        llm._build_prompt(  # type: ignore
+            message,
+            system_prompt,
+            botconf.bot_config.context_token_budget,
+        )
+    return run
+
+
+def _bench_encode_request() -> Callable[[], object]:
+    message, system_prompt = _fill_history()
+    prompt = llm._build_prompt(  # type: ignore
+        message,
+        system_prompt,
+        botconf.bot_config.context_token_budget,
+    )
+    fields = {"model": "llama3", "stream": True, "keep_alive": "5m"}
+
+    def run() -> None:
+        prompt.encode(fields)
+    return run
+
+
+BENCHMARKS: dict[str, Callable[[], Callable[[], object]]] = {
+    "split_text": _bench_split_text,
+    "is_greeting": _bench_is_greeting,
+    "is_command": _bench_is_command,
+    "add_message": _bench_add_message,
+    "merge_configs": _bench_merge_configs,
+    "parse_config": _bench_parse_config,
+    "build_messages": _bench_build_messages,
+    "encode_request": _bench_encode_request,
+}
+
+
+def run_benchmarks(names: list[str], repeat: int) -> dict[str, float]:
+    """
+    Run the benchmarks, and return the best time of each, in seconds
+    """
+    results = {}
+    for name in names:
+        fn = BENCHMARKS[name]()
+        number, _ = timeit.Timer(fn).autorange()
+        best = min(timeit.repeat(fn, number=number, repeat=repeat))
+        results[name] = best / number
+        print(f"{name:16} {results[name] * 1000:10.3f}ms")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("names", nargs="*",
+                        help="benchmarks to run (all by default): " +
+                        ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results against a baseline")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    # Benchmark with the default config
+    botconf.load_config(io.StringIO(""))
+
+    results = run_benchmarks(args.names or list(BENCHMARKS), args.repeat)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+        print("\ncompared to " + args.compare)
+        for name, t in results.items():
+            if name in baseline:
+                print(f"{name:16} {t / baseline[name]:10.2f}x")
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, f, indent=2)
+        print(f"\nsaved results to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Offline load test of the bot's message handling.
+
+Feeds synthetic messages from many users in many channels into the
+bot's `on_message` handler, with the LLM requests going to a local stub
+of the Ollama server (see `ollama_stub.py`), and reports throughput,
+reply latency, peak memory and event loop lag.
+No Discord connection or GPU is needed.
+
+Usage: python tools/loadtest.py [--messages 500] [--rate 50] ...
+"""
+
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import io
+import itertools
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+import yaml
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"),
+)
+
+import globalconf  # noqa: E402
+
+import ollama_stub  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False) -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{self.id}>"
+        self.bot = bot
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class _Typing:
+    async def __aenter__(self) -> None:
+        pass
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class FakeChannel:
+    def __init__(self, test: "LoadTest") -> None:
+        self.id = next(_ids)
+        self.test = test
+        self.messages: list[FakeMessage] = []
+
+    def typing(self) -> _Typing:
+        return _Typing()
+
+    async def send(self, content: str, **kwargs) -> "FakeMessage":
+        return await self.test.post(self, content, self.test.bot_user)
+
+    async def history(
+        self,
+        limit: int | None = 100,
+        before: "FakeMessage | None" = None,
+        **kwargs,
+    ):
+        await asyncio.sleep(self.test.discord_latency)
+        messages = [
+            m for m in self.messages if before is None or m.id < before.id
+        ]
+        for message in reversed(messages[-(limit or 100):]):
+            yield message
+
+
+class FakeReference:
+    def __init__(self, message_id: int) -> None:
+        self.message_id = message_id
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        content: str,
+        author: FakeUser,
+        channel: FakeChannel,
+        mentions: list[FakeUser],
+    ) -> None:
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = mentions
+        self.guild = None
+        self.reference: FakeReference | None = None
+        self.created_at = datetime.now(timezone.utc)
+        self.sent_at = time.perf_counter()
+        self.replied_at: float | None = None
+
+    async def reply(self, content: str, **kwargs) -> "FakeMessage":
+        if self.replied_at is None:
+            self.replied_at = time.perf_counter()
+        reply = await self.channel.test.post(
+            self.channel, content, self.channel.test.bot_user,
+        )
+        reply.reference = FakeReference(self.id)
+        return reply
+
+    async def edit(self, content: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.channel.test.discord_latency)
+        self.content = content
+        return self
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.discord_latency = args.discord_latency
+        self.bot_user = FakeUser("bot", bot=True)
+        self.users = [FakeUser(f"user{i}") for i in range(args.users)]
+        self.channels = [FakeChannel(self) for _ in range(args.channels)]
+        self.mentions: list[FakeMessage] = []
+        self.lags: list[float] = []
+
+    async def post(
+        self,
+        channel: FakeChannel,
+        content: str,
+        author: FakeUser,
+    ) -> FakeMessage:
+        """Simulate sending a message to Discord"""
+        await asyncio.sleep(self.discord_latency)
+        message = FakeMessage(content, author, channel, [])
+        channel.messages.append(message)
+        return message
+
+    def make_message(self) -> FakeMessage:
+        channel = self.rng.choice(self.channels)
+        author = self.rng.choice(self.users)
+        mentioned = self.rng.random() < self.args.mention_ratio
+        words = " ".join(
+            self.rng.choice(("pi", "gpio", "ssh", "kernel", "sd", "card"))
+            for _ in range(self.rng.randint(3, 40))
+        )
+        content = (
+            f"{self.bot_user.mention} {words}?" if mentioned else words
+        )
+        message = FakeMessage(
+            content,
+            author,
+            channel,
+            [self.bot_user] if mentioned else [],
+        )
+        channel.messages.append(message)
+        if mentioned:
+            self.mentions.append(message)
+        return message
+
+    async def measure_lag(self, interval: float = 0.01) -> None:
+        """Record how late the event loop wakes up from sleeping"""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lags.append(time.perf_counter() - start - interval)
+
+    async def run(self, bot) -> float:
+        lag_task = asyncio.create_task(self.measure_lag())
+        tasks = []
+        start = time.perf_counter()
+        for _ in range(self.args.messages):
+            message = self.make_message()
+            tasks.append(asyncio.create_task(bot.on_message(message)))
+            await asyncio.sleep(self.rng.expovariate(self.args.rate))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        lag_task.cancel()
+        return elapsed
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _run_stub(config: ollama_stub.StubConfig) -> str:
+    """
+    Run the stub server on its own thread and event loop, so it doesn't
+    add to the measured event loop lag. Return its base URL.
+    """
+    started = threading.Event()
+    url: list[str] = []
+
+    def run() -> None:
+        loop = asyncio.new_event_loop()
+        _, stub_url = loop.run_until_complete(ollama_stub.start(config))
+        url.append(stub_url)
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return url[0]
+
+
+async def main(args: argparse.Namespace) -> None:
+    stub_url = args.stub_url or _run_stub(ollama_stub.StubConfig(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+    ))
+    globalconf.LLM_BACKENDS = [stub_url]
+
+    import bot
+    from bot import botconf
+
+    overrides = {
+        "stream_responses": args.stream,
+        "persist_history": False,
+    }
+    if args.history_mode is not None:
+        overrides["history_mode"] = args.history_mode
+    if not args.admission:
+        overrides.update({
+            "user_rate_limit": 0,
+            "channel_rate_limit": 0,
+            "admission_max_wait": 0,
+        })
+    if args.config is not None:
+        with open(args.config, "r") as f:
+            overrides = {**(yaml.safe_load(f) or {}), **overrides}
+    botconf.load_config(io.StringIO(yaml.safe_dump(overrides)))
+
+    test = LoadTest(args)
+
+    # Pretend to be logged in, without connecting to Discord
+    bot.client._connection.user = test.bot_user  # type: ignore
+
+    async def change_presence(*args, **kwargs) -> None:
+        pass
+
+    bot.client.change_presence = change_presence  # type: ignore
+    await bot.on_ready()
+
+    elapsed = await test.run(bot)
+    await bot.client.close()
+
+    latencies = [
+        m.replied_at - m.sent_at
+        for m in test.mentions if m.replied_at is not None
+    ]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"messages:        {args.messages} in {elapsed:.2f}s " +
+          f"({args.messages / elapsed:.1f} messages/s)")
+    print(f"mentions:        {len(test.mentions)} " +
+          f"({len(latencies)} answered)")
+    for p in (50, 95, 99):
+        print(f"reply p{p}:       " +
+              f"{_percentile(latencies, p) * 1000:.1f}ms")
+    print(f"peak RSS:        {peak_rss:.1f}MiB")
+    print(f"loop lag p99:    {_percentile(test.lags, 99) * 1000:.2f}ms")
+    print(f"loop lag max:    {max(test.lags, default=0) * 1000:.2f}ms")
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=500,
+                        help="number of messages to send")
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="average messages per second")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--mention-ratio", type=float, default=0.2,
+                        help="fraction of messages that mention the bot")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction,
+                        default=True, help="stream responses")
+    parser.add_argument("--history-mode", choices=("eager", "lazy"),
+                        default=None,
+                        help="override the history_mode of the config")
+    parser.add_argument("--admission",
+                        action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="apply the rate limits of the config")
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="stub seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=60,
+                        help="tokens per stub response")
+    parser.add_argument("--discord-latency", type=float, default=0.05,
+                        help="simulated seconds per Discord API call")
+    parser.add_argument("--stub-url", default=None,
+                        help="use an already running stub or Ollama server")
+    parser.add_argument("--config", default=None,
+                        help="bot config file to test with")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(_parse_args()))
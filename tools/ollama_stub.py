@@ -0,0 +1,220 @@
+"""
+A stand-in for an Ollama server, for testing the bot offline.
+
+It implements the parts of the Ollama API the bot uses, and answers
+every chat request with filler text after a configurable delay.
+Embeddings are word counts hashed into a small vector, so texts that
+share words are similar.
+
+Usage: python tools/ollama_stub.py [--port 11434] [--latency 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import re
+import time
+import zlib
+
+from aiohttp import web
+
+_FILLER = (
+    "The Raspberry Pi is a small single board computer. "
+    "You can flash an SD card with the Raspberry Pi Imager. "
+)
+
+
+class StubConfig:
+    latency: float
+    """Seconds before the first token of a response"""
+    tokens_per_sec: float
+    """Speed at which the rest of the response is streamed"""
+    tokens: int
+    """Number of tokens in each response"""
+    models: list[str]
+    """Models the server pretends to have"""
+    truncate_pull: bool
+    """Whether pulls end with a truncated progress line"""
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        tokens_per_sec: float = 50.0,
+        tokens: int = 60,
+        models: list[str] | None = None,
+        truncate_pull: bool = False,
+    ) -> None:
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.models = models or ["llama2:latest", "nomic-embed-text:latest"]
+        self.truncate_pull = truncate_pull
+
+
+def _response_tokens(config: StubConfig) -> list[str]:
+    words = (_FILLER * (config.tokens // 10 + 1)).split(" ")
+    return [w + " " for w in words[:config.tokens]]
+
+
+_EMBEDDING_DIM = 64
+
+
+def _embedding(text: str) -> list[float]:
+    vector = [0.0] * _EMBEDDING_DIM
+    for word in re.findall(r"\w+", text.lower()):
+        vector[zlib.crc32(word.encode()) % _EMBEDDING_DIM] += 1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _durations(config: StubConfig, started: float, prompt: int) -> dict:
+    total = int((time.monotonic() - started) * 1_000_000_000)
+    load = 0
+    prompt_eval = int(config.latency * 1_000_000_000)
+    return {
+        "total_duration": total,
+        "load_duration": load,
+        "prompt_eval_count": prompt,
+        "prompt_eval_duration": prompt_eval,
+        "eval_count": config.tokens,
+        "eval_duration": max(0, total - prompt_eval - load),
+    }
+
+
+def make_app(config: StubConfig) -> web.Application:
+    """
+    Create the stub server's application
+    """
+    async def chat(request: web.Request) -> web.StreamResponse:
+        started = time.monotonic()
+        body = await request.json()
+        prompt = sum(
+            len(m.get("content", "")) // 4 + 4
+            for m in body.get("messages", [])
+        )
+        model = body.get("model", "")
+        tokens = _response_tokens(config)
+        delay = 1 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+
+        await asyncio.sleep(config.latency)
+
+        if not body.get("stream", True):
+            await asyncio.sleep(delay * len(tokens))
+            return web.json_response({
+                "model": model,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "done": True,
+                **_durations(config, started, prompt),
+            })
+
+        res = web.StreamResponse()
+        res.content_type = "application/x-ndjson"
+        await res.prepare(request)
+        try:
+            for token in tokens:
+                await res.write(json.dumps({
+                    "model": model,
+                    "message": {"role": "assistant", "content": token},
+                    "done": False,
+                }).encode() + b"\n")
+                await asyncio.sleep(delay)
+            await res.write(json.dumps({
+                "model": model,
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                **_durations(config, started, prompt),
+            }).encode() + b"\n")
+        except ConnectionResetError:
+            # The client went away, so stop generating, like Ollama
+            pass
+        return res
+
+    async def generate(request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({
+            "model": body.get("model", ""),
+            "response": "",
+            "done": True,
+            "load_duration": 0,
+        })
+
+    async def embed(request: web.Request) -> web.Response:
+        body = await request.json()
+        texts = body.get("input", "")
+        if isinstance(texts, str):
+            texts = [texts]
+        return web.json_response({
+            "model": body.get("model", ""),
+            "embeddings": [_embedding(t) for t in texts],
+        })
+
+    async def tags(request: web.Request) -> web.Response:
+        return web.json_response({
+            "models": [{"name": m} for m in config.models],
+        })
+
+    async def pull(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        res = web.StreamResponse()
+        await res.prepare(request)
+        for completed in range(0, 101, 20):
+            await res.write(json.dumps({
+                "status": "downloading",
+                "total": 100,
+                "completed": completed,
+            }).encode() + b"\n")
+            await asyncio.sleep(0.1)
+        if config.truncate_pull:
+            await res.write(b'{"status": "downloa\n')
+            return res
+        config.models.append(body.get("model") or body.get("name"))
+        await res.write(b'{"status": "success"}\n')
+        return res
+
+    app = web.Application()
+    app.router.add_post("/api/chat", chat)
+    app.router.add_post("/api/generate", generate)
+    app.router.add_post("/api/embed", embed)
+    app.router.add_get("/api/tags", tags)
+    # Pretend every model is loaded
+    app.router.add_get("/api/ps", tags)
+    app.router.add_post("/api/pull", pull)
+    return app
+
+
+async def start(
+    config: StubConfig,
+    host: str = "127.0.0.1",
+    port: int = 0,
+) -> tuple[web.AppRunner, str]:
+    """
+    Start the stub server on the running event loop.
+    Return the runner (to clean up with) and the server's base URL.
+    """
+    runner = web.AppRunner(make_app(config))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    # Find the actual port if it was chosen by the OS
+    server = site._server
+    assert server is not None
+    port = server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+    return runner, f"http://{host}:{port}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=60)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.tokens_per_sec, args.tokens)
+    web.run_app(make_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()